@@ -0,0 +1,308 @@
+"""
+Benchmarks the Eywa pipeline (synthesis, KLEE, decoding and validation, and
+the translation of tests done by the scripts) on the DNS, BGP and SMTP
+models in scripts/, without spending OpenAI quota or needing the KLEE image.
+
+A benchmark is first recorded once against the real services:
+
+    python benchmarks/pipeline.py dns:cname --record --runs 2 --timeout 60
+
+which stores the LLM completions in <recordings>/<suite>/completions.jsonl
+and the .ktest files KLEE generated in <recordings>/<suite>/ktests/. Later
+runs replay both, so they measure Eywa itself:
+
+    python benchmarks/pipeline.py dns:cname bgp:confed smtp:server --runs 2
+
+Pass --live-klee to replay the completions but run the real KLEE, and
+--klee-preset to compare KLEE profiles (each preset is recorded separately,
+since the tests depend on the KLEE options). For each
+suite it reports the wall time of every stage, tests/s, unique tests/s, the
+peak RSS of the process and the number of KLEE paths (KLEE writes one test
+per completed path). The runs overlap synthesis and KLEE in threads, so the
+stage times are totals per stage and may add up to more than the wall time.
+"""
+import hashlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from eywa.composer import DependencyGraph
+from eywa.klee import KLEE_PRESETS, KleePool
+from eywa.ktest import read_ktest, write_ktest
+from eywa.llm import CompletionCache, CompletionRecording
+from eywa.oracles import KleeOracle
+from eywa.run import make_hashable
+
+SUITES = {
+    "dns:cname": ("dns", "cname_match_check"),
+    "dns:dname": ("dns", "dname_match_check"),
+    "dns:wildcard": ("dns", "wildcard_match_check"),
+    "dns:ipv4": ("dns", "ipv4_match_check"),
+    "dns:full_lookup": ("dns", "full_query_lookup"),
+    "dns:loop_count": ("dns", "loop_count"),
+    "dns:rcode": ("dns", "return_code_lookup"),
+    "dns:authoritative": ("dns", "authoritative_lookup"),
+    "bgp:confed": ("bgp", "confed_check"),
+    "bgp:rr": ("bgp", "rr_check"),
+    "bgp:rmap_pl": ("bgp", "rmap_pl_check"),
+    "bgp:rr_rmap": ("bgp", "rr_rmap_check"),
+    "smtp:server": ("smtp", "server_check"),
+}
+
+
+def program_hash(program: str) -> str:
+    return hashlib.sha256(program.encode("utf-8")).hexdigest()
+
+
+class ReplayKleePool:
+    """
+    A stand-in for KleePool that yields the .ktest files captured for a
+    program instead of running KLEE.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.size = 1
+
+    def stream(self, program: str, timeout: int, options=None, interrupt=None):
+        directory = os.path.join(self.directory, program_hash(program))
+        if not os.path.isdir(directory):
+            raise Exception(f'No captured KLEE tests for program {program_hash(program)}')
+        start = time.time()
+        for name in sorted(os.listdir(directory)):
+            if interrupt is not None and interrupt(start):
+                return
+            if name.endswith(".ktest"):
+                with open(os.path.join(directory, name), "rb") as f:
+                    yield read_ktest(f.read(), name)
+
+    def run(self, program: str, timeout: int, options=None):
+        return list(self.stream(program, timeout, options))
+
+    def resize(self, size: int) -> None:
+        self.size = size
+
+    def shutdown(self, remove: bool = False) -> None:
+        pass
+
+
+class CapturingKleePool:
+    """
+    Wraps a KleePool and saves every test it produces, keyed by the hash of
+    the program, so that the run can be replayed by ReplayKleePool.
+    """
+
+    def __init__(self, pool: KleePool, directory: str):
+        self.pool = pool
+        self.directory = directory
+        self.size = pool.size
+
+    def stream(self, program: str, timeout: int, options=None, interrupt=None):
+        directory = os.path.join(self.directory, program_hash(program))
+        os.makedirs(directory, exist_ok=True)
+        for (i, record) in enumerate(self.pool.stream(program, timeout, options, interrupt=interrupt)):
+            name = record.name or f"test{i + 1:06d}.ktest"
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(write_ktest(record))
+            yield record
+
+    def run(self, program: str, timeout: int, options=None):
+        return list(self.stream(program, timeout, options))
+
+    def resize(self, size: int) -> None:
+        self.pool.resize(size)
+        self.size = size
+
+    def shutdown(self, remove: bool = False) -> None:
+        self.pool.shutdown(remove)
+
+
+class StageTimer:
+    """
+    Accumulates wall time and counters per stage across threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, stage: str, elapsed: float, count: int = 0) -> None:
+        with self.lock:
+            self.times[stage] += elapsed
+            self.counts[stage] += count
+
+    def timed(self, stage: str, f):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - start)
+        return wrapper
+
+    def timed_stream(self, stage: str, f):
+        """
+        Wraps a generator function, counting the time spent producing items
+        (not the time the consumer holds them) and the number of items.
+        """
+        def wrapper(*args, **kwargs):
+            generator = f(*args, **kwargs)
+            while True:
+                start = time.time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    self.add(stage, time.time() - start)
+                    return
+                self.add(stage, time.time() - start, 1)
+                yield item
+        return wrapper
+
+
+class TimedPool:
+    """
+    Wraps a pool to time the KLEE stage and count the tests it produces.
+    """
+
+    def __init__(self, pool, timer: StageTimer):
+        self.pool = pool
+        self.size = pool.size
+        self.stream = timer.timed_stream("klee", pool.stream)
+
+    def run(self, program: str, timeout: int, options=None):
+        return list(self.stream(program, timeout, options))
+
+    def resize(self, size: int) -> None:
+        self.pool.resize(size)
+        self.size = size
+
+    def shutdown(self, remove: bool = False) -> None:
+        self.pool.shutdown(remove)
+
+
+def run_suite(suite: str, args) -> dict:
+    """
+    Runs one benchmark suite and returns its measurements.
+    """
+    (module_name, function_name) = SUITES[suite]
+    module = __import__(module_name)
+    recording = os.path.join(os.path.abspath(args.recordings), suite.replace(":", "_"))
+    # tests depend on the KLEE options, so every preset has its own capture.
+    ktests = os.path.join(recording, "ktests" if args.klee_preset == "default" else f"ktests_{args.klee_preset}")
+    # every run should do the work being measured, and every completion
+    # must go through the recording rather than the node store.
+    os.environ["EYWA_RESULT_STORE"] = "0"
+    os.environ["EYWA_NODE_STORE"] = "0"
+
+    CompletionCache.set_shared(CompletionRecording(
+        os.path.join(recording, "completions.jsonl"), record=args.record))
+    if args.record:
+        pool = CapturingKleePool(KleePool(size=args.klee_workers), ktests)
+    elif args.live_klee:
+        pool = KleePool(size=args.klee_workers)
+    else:
+        pool = ReplayKleePool(ktests)
+    timer = StageTimer()
+    KleePool.set_shared(TimedPool(pool, timer))
+
+    # time each stage by wrapping the functions that implement it.
+    original_synthesize = DependencyGraph.synthesize
+    original_iter_inputs = KleeOracle.iter_inputs
+    original_run = module.run
+    # tests found by several run() calls (the DNS suites call it once per
+    # temperature) are counted once, as run() does within a call.
+    unique_tests = set()
+
+    def run(graph, **kwargs):
+        if not args.record:
+            kwargs["ratelimit_sec"] = 0
+        kwargs["klee_workers"] = args.klee_workers
+        kwargs["klee_options"] = args.klee_preset
+        inputs = original_run(graph, **kwargs)
+        unique_tests.update(make_hashable(test) for test in inputs)
+        return inputs
+
+    DependencyGraph.synthesize = timer.timed("synthesis", original_synthesize)
+    KleeOracle.iter_inputs = timer.timed_stream("explore", original_iter_inputs)
+    module.run = timer.timed("run", run)
+    # the scripts write their outputs relative to the working directory.
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix="eywa_bench_")
+    os.makedirs(os.path.join(work, "work"))
+    if os.path.exists("openai_key.txt"):
+        os.symlink(os.path.abspath("openai_key.txt"), os.path.join(work, "work", "openai_key.txt"))
+    os.chdir(os.path.join(work, "work"))
+    start = time.time()
+    try:
+        getattr(module, function_name)(args.runs, args.timeout)
+    finally:
+        elapsed = time.time() - start
+        os.chdir(cwd)
+        DependencyGraph.synthesize = original_synthesize
+        KleeOracle.iter_inputs = original_iter_inputs
+        module.run = original_run
+        KleePool.set_shared(None)
+        if not args.record and not args.live_klee:
+            pool.shutdown()
+
+    tests = timer.counts["explore"]
+    return {
+        "suite": suite,
+        "klee_preset": args.klee_preset,
+        "wall_sec": elapsed,
+        "synthesis_sec": timer.times["synthesis"],
+        "klee_sec": timer.times["klee"],
+        "decode_validate_sec": max(0.0, timer.times["explore"] - timer.times["klee"]),
+        "translate_sec": max(0.0, elapsed - timer.times["run"]),
+        "klee_paths": timer.counts["klee"],
+        "tests": tests,
+        "unique_tests": len(unique_tests),
+        "tests_per_sec": tests / elapsed if elapsed > 0 else 0.0,
+        "unique_tests_per_sec": len(unique_tests) / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "output_dir": work,
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the Eywa pipeline with recorded completions and KLEE tests.")
+    parser.add_argument("suites", nargs="+", choices=sorted(SUITES), help="The benchmarks to run.")
+    parser.add_argument("-r", "--runs", type=int, default=1, help="Number of models per benchmark.")
+    parser.add_argument("--timeout", type=int, default=60, help="KLEE max-time in seconds.")
+    parser.add_argument("--klee-workers", type=int, default=1, help="Number of KLEE containers.")
+    parser.add_argument("--klee-preset", type=str, default="default", choices=sorted(KLEE_PRESETS),
+                        help="KLEE search and resource profile.")
+    parser.add_argument("--recordings", type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings"),
+                        help="Directory holding the recorded completions and KLEE tests.")
+    parser.add_argument("--record", action="store_true", help="Call the LLM and KLEE and record their outputs.")
+    parser.add_argument("--live-klee", action="store_true", help="Replay completions but run the real KLEE.")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = []
+    for suite in args.suites:
+        result = run_suite(suite, args)
+        results.append(result)
+        print(f"{suite} ({args.klee_preset}): {result['wall_sec']:.2f}s wall "
+              f"(synthesis {result['synthesis_sec']:.2f}s, klee {result['klee_sec']:.2f}s, "
+              f"decode/validate {result['decode_validate_sec']:.2f}s, translate {result['translate_sec']:.2f}s), "
+              f"{result['klee_paths']} paths, {result['tests']} tests ({result['tests_per_sec']:.1f}/s), "
+              f"{result['unique_tests']} unique ({result['unique_tests_per_sec']:.1f}/s), "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB", flush=True)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
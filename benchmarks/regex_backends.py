@@ -0,0 +1,76 @@
+"""
+Compares the regex matchers emitted for KLEE by the 'backtracking' and
+'dfa' backends on the domain name validation used by the DNS cname and
+dname models (scripts/dns.py). The harness validates a query name and a
+record name like the is_valid_inputs function of those models, without
+calling the LLM, and reports the number of KLEE paths (one test is written
+per completed path) and tests per second for each backend.
+
+    python benchmarks/regex_backends.py --timeout 60 --maxsize 5
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import eywa.ast as ast
+import eywa.oracles as oracles
+from eywa.klee import KleePool
+from dns import build_regex_module
+
+HEADERS = """#include <stdint.h>
+#include <stdbool.h>
+#include <string.h>
+#include <stdlib.h>
+#include <klee/klee.h>
+#include <stdio.h>
+"""
+
+WRAPPER = """
+bool is_valid_inputs(char* query, char* domain_name) {
+    return is_valid_domain_name(query) && is_valid_domain_name(domain_name);
+}
+"""
+
+
+def build_program(backend: str, maxsize: int) -> str:
+    """
+    Builds the KLEE program for the domain name checks with a regex backend.
+    """
+    module = build_regex_module(maxsize=maxsize)
+    module_oracle = oracles.KleeOracle(module, regex_backend=backend)
+    module_oracle.build_eywa_regex_model()
+
+    query = ast.Parameter("query", ast.String(maxsize), "The query domain name")
+    domain_name = ast.Parameter("domain_name", ast.String(maxsize), "The record domain name")
+    is_valid = ast.Parameter("is_valid", ast.Bool(), "whether both domain names are valid")
+    is_valid_inputs = ast.Function("is_valid_inputs", "checks the domain names", [query, domain_name, is_valid])
+    oracle = oracles.KleeOracle(is_valid_inputs, regex_backend=backend)
+    return (HEADERS + oracle._regex_impl() + "\n" + module_oracle.implementation + "\n"
+            + WRAPPER + "\n" + oracle._build_klee_main())
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--timeout", type=int, default=60, help="KLEE max-time in seconds.")
+    parser.add_argument("--maxsize", type=int, default=5, help="Maximum domain name length.")
+    parser.add_argument("--emit", action="store_true", help="Print the generated programs instead of running KLEE.")
+    args = parser.parse_args()
+
+    for backend in ["backtracking", "dfa"]:
+        program = build_program(backend, args.maxsize)
+        if args.emit:
+            print(f"// regex backend: {backend}\n{program}")
+            continue
+        start = time.time()
+        tests = 0
+        for _ in KleePool.shared().stream(program, args.timeout):
+            tests += 1
+        elapsed = time.time() - start
+        print(f"{backend:>12}: {tests} paths in {elapsed:.1f}s ({tests / elapsed:.1f} tests/s)", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,7 +24,7 @@ def int_to_prefix(value: int, prefix_len: int) -> str:
     network = ipaddress.IPv4Network(f"{ip}/{prefix_len}", strict=False)
     return str(network)
 
-def confed_check(runs, timeout):
+def confed_check(runs, timeout, budget=0, temperatures=None):
     
     """
     
@@ -115,7 +115,7 @@ A few points to keep in mind:
     g.Pipe(confederation_model, valid_input_model)
     
     output_dir = output_dir_common / "CONFED"
-    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout)
+    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
 
     ## Save test cases
 
@@ -154,7 +154,7 @@ A few points to keep in mind:
         json.dump(test_cases, f, indent=4)
     print(f"[DONE] Generated {len(test_cases)} test cases for BGP confederation check.")
     
-def rr_check(runs, timeout):
+def rr_check(runs, timeout, budget=0, temperatures=None):
     """
     --------->------- R2 --------->-------
 
@@ -224,7 +224,7 @@ You have to take into consideration all BGP route reflector rules, eBGP, iBGP ru
     g.Pipe(rr_model, router_validity_model)
 
     output_dir = output_dir_common / "RR"
-    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout)
+    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
 
     ## Save test cases
     test_dir = output_dir
@@ -250,7 +250,7 @@ You have to take into consideration all BGP route reflector rules, eBGP, iBGP ru
         json.dump(test_cases, f, indent=4)
     print(f"[DONE] Generated {len(test_cases)} test cases for BGP route reflector check.")
 
-def rmap_pl_check(runs, timeout):
+def rmap_pl_check(runs, timeout, budget=0, temperatures=None):
     # Define a prefixListEntry struct with fields prefix, prefixLength, le, ge, any, permit
     pr_list_entry = ast.Struct(
         "PrefixListEntry",
@@ -378,7 +378,7 @@ If a match is found, the function should update the Result struct's isPermitted
     g.Pipe(rmap_match_model, valid_input_model)
 
     output_dir = output_dir_common / "RMAP_PL"
-    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout)
+    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
     
     ## Save test cases
     test_dir = output_dir
@@ -419,7 +419,7 @@ If a match is found, the function should update the Result struct's isPermitted
         json.dump(test_cases, f, indent=4)
     print(f"[DONE] Generated {len(test_cases)} test cases for BGP route map with single-entry prefix list.")
 
-def rr_rmap_check(runs, timeout):
+def rr_rmap_check(runs, timeout, budget=0, temperatures=None):
     """
     input parameters:
     1. inRRflag : 
@@ -626,7 +626,7 @@ If R2 receives the route, then before advertising it to other interfaces, it app
     g.Pipe(rr_model, input_validity_model)
 
     output_dir = output_dir_common / "RR_RMAP"
-    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout)
+    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
 
     ## Save test cases
     test_dir = output_dir
@@ -691,16 +691,20 @@ if __name__ == "__main__":
                         help="Number of runs to generate inputs for.", default=10)
     parser.add_argument("--timeout", type=int, required=False,
                         help="Timeout in seconds for each run.", default=300)
+    parser.add_argument("--budget", type=float, required=False,
+                        help="Total time in seconds for each run, spent adaptively on the temperatures that find the most unique tests per second; --runs then caps the number of models. 0 disables it.", default=0)
+    parser.add_argument("--temperatures", type=float, nargs="+", required=False,
+                        help="The temperatures to choose from when a budget is given.", default=[0.2, 0.4, 0.6, 0.8, 1.0])
     args = parser.parse_args()
     # NSDI = args.nsdi
     if args.module == "confed":
-        confed_check(args.runs, args.timeout)
+        confed_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "rr":
-        rr_check(args.runs, args.timeout)
+        rr_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "rmap_pl":
-        rmap_pl_check(args.runs, args.timeout)
+        rmap_pl_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "rr_rmap":
-        rr_rmap_check(args.runs, args.timeout)
+        rr_rmap_check(args.runs, args.timeout, args.budget, args.temperatures)
     else:
         print("Invalid module selected.")
 
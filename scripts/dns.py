@@ -1,4 +1,5 @@
 import json
+import os
 import pathlib
 from typing import Generator, List, Tuple
 import eywa
@@ -11,6 +12,24 @@ from argparse import ArgumentParser
 NSDI = False
 output_dir_common = pathlib.Path("..//tests//dns//NSDI")
 
+
+def temperature_sweep(budget, temperatures):
+    """
+    Returns the (directory name, run() arguments) of the runs of a module:
+    one per temperature, or a single adaptive run if a budget is given. If
+    EYWA_TRACE is set, each run writes its trace under its own prefix.
+    """
+    if budget > 0:
+        sweep = [("adaptive", {"budget_sec": budget, "temperatures": temperatures})]
+    else:
+        sweep = [(temperature, {"temperature_value": temperature}) for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]]
+    trace = os.environ.get("EYWA_TRACE")
+    if trace:
+        for (name, options) in sweep:
+            options["trace"] = f"{trace}_{name}"
+    return sweep
+
+
 def build_regex_module(maxsize=5):
     valid_dn_re = "[a-z\\*](\\.[a-z\\*])*"
     domain_name = eywa.String(maxsize=maxsize)
@@ -72,7 +91,7 @@ def generate_zone_query_inputs_from_zone(zone_input: List[Tuple[List[dict], str]
             f.write(input[0])
 
 
-def cname_match_check(runs, timeout):
+def cname_match_check(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(5)
     
     query_dn = ast.Parameter("domain_name", domain_name,description="The domain name to check")
@@ -107,7 +126,7 @@ def cname_match_check(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "CNAME"
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             query_zone_tuples.append(create_cname_zone(input))
@@ -115,11 +134,11 @@ def cname_match_check(runs, timeout):
     else:
         output_dir = pathlib.Path("CNAME")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     query_zone_tuples.append(create_cname_zone(input))
@@ -127,7 +146,7 @@ def cname_match_check(runs, timeout):
                     query_zone_tuples, (output_dir / f"{temperature}" / f"{i}"))
 
 
-def dname_match_check(runs, timeout):
+def dname_match_check(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(5)
 
     query_dn = ast.Parameter("domain_name", domain_name, description="The domain name to check")
@@ -162,7 +181,7 @@ def dname_match_check(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "DNAME"
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             query_zone_tuples.append(create_dname_zone(input))
@@ -170,11 +189,11 @@ def dname_match_check(runs, timeout):
     else:
         output_dir = pathlib.Path("DNAME")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     query_zone_tuples.append(create_dname_zone(input))
@@ -182,7 +201,7 @@ def dname_match_check(runs, timeout):
                     query_zone_tuples, (output_dir / f"{temperature}" / f"{i}"))
 
 
-def ipv4_match_check(runs, timeout):
+def ipv4_match_check(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(5)
 
     query_dn = ast.Parameter("domain_name", domain_name, description="The domain name to check")
@@ -217,7 +236,7 @@ def ipv4_match_check(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "IPv4"
         inputs = run(g, k=runs,
-                     debug=output_dir,  timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             query_zone_tuples.append(create_ipv4_zone(input))
@@ -225,11 +244,11 @@ def ipv4_match_check(runs, timeout):
     else:
         output_dir = pathlib.Path("IPv4")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     query_zone_tuples.append(create_ipv4_zone(input))
@@ -316,7 +335,7 @@ def validate_domain_name():
             f.write(json.dumps(queries))
 
 
-def wildcard_match_check(runs, timeout):
+def wildcard_match_check(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(5)
     
     query_dn = ast.Parameter("domain_name", domain_name, description="The domain name to check")
@@ -350,7 +369,7 @@ def wildcard_match_check(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "Wildcard"
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             query_zone_tuples.append(create_wildcard_zone(input))
@@ -358,11 +377,11 @@ def wildcard_match_check(runs, timeout):
     else:
         output_dir = pathlib.Path("Wildcard")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     query_zone_tuples.append(create_wildcard_zone(input))
@@ -493,7 +512,7 @@ def valid_zone_check(runs, timeout):
     generate_zone_query_inputs_from_zone(query_zone_tuples, output_dir)
 
 
-def full_query_lookup(runs, timeout):
+def full_query_lookup(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(3)
 
     record_type = ast.Enum(
@@ -550,7 +569,7 @@ def full_query_lookup(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "FullLookup"
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             zone_file, zone_origin = create_zone(input)
@@ -567,11 +586,11 @@ def full_query_lookup(runs, timeout):
     else:
         output_dir = pathlib.Path("FullLookup")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     # print("Input:", input)
@@ -591,7 +610,7 @@ def full_query_lookup(runs, timeout):
                     query_zone_tuples, (output_dir / f"{temperature}" / f"{i}"))
 
 
-def return_code_lookup(runs, timeout):
+def return_code_lookup(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(3)
 
     record_type = ast.Enum(
@@ -648,7 +667,7 @@ def return_code_lookup(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "RCODE"
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             zone_file, zone_origin = create_zone(input)
@@ -665,11 +684,11 @@ def return_code_lookup(runs, timeout):
     else:
         output_dir = pathlib.Path("RCODE")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     zone_file, zone_origin = create_zone(input)
@@ -687,7 +706,7 @@ def return_code_lookup(runs, timeout):
                     query_zone_tuples, (output_dir / f"{temperature}" / f"{i}"))
 
 
-def authoritative_lookup(runs, timeout):
+def authoritative_lookup(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(3)
 
     record_type = ast.Enum(
@@ -746,7 +765,7 @@ def authoritative_lookup(runs, timeout):
     if NSDI:
         output_dir = output_dir_common / "Authoritative"
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             zone_file, zone_origin = create_zone(input)
@@ -763,11 +782,11 @@ def authoritative_lookup(runs, timeout):
     else:
         output_dir = pathlib.Path("Authoritative")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     zone_file, zone_origin = create_zone(input)
@@ -785,7 +804,7 @@ def authoritative_lookup(runs, timeout):
                     query_zone_tuples, (output_dir / f"{temperature}" / f"{i}"))
 
 
-def loop_count(runs, timeout):
+def loop_count(runs, timeout, budget=0, temperatures=None):
     domain_name = ast.String(3)
 
     record_type = ast.Enum(
@@ -847,7 +866,7 @@ def loop_count(runs, timeout):
         output_dir = output_dir_common / "LoopCount"
 
         inputs = run(g, k=runs,
-                     debug=output_dir, timeout_sec=timeout)
+                     debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
         query_zone_tuples = []
         for input in inputs:
             zone_file, zone_origin = create_zone(input)
@@ -864,11 +883,11 @@ def loop_count(runs, timeout):
     else:
         output_dir = pathlib.Path("LoopCount")
         for i in range(0, 1):
-            for temperature in [0.2, 0.4, 0.6, 0.8, 1.0]:
+            for (temperature, options) in temperature_sweep(budget, temperatures):
                 (output_dir / f"{temperature}" /
                  f"{i}").mkdir(exist_ok=True, parents=True)
                 inputs = run(g, k=runs,
-                             debug=output_dir / f"{temperature}" / f"{i}", temperature_value=temperature, timeout_sec=timeout)
+                             debug=output_dir / f"{temperature}" / f"{i}", timeout_sec=timeout, **options)
                 query_zone_tuples = []
                 for input in inputs:
                     zone_file, zone_origin = create_zone(input)
@@ -982,23 +1001,27 @@ if __name__ == "__main__":
                         help="Number of runs to generate inputs for.", default=10)
     parser.add_argument("--timeout", type=int, required=False,
                         help="Timeout in seconds for each run.", default=300)
+    parser.add_argument("--budget", type=float, required=False,
+                        help="Total time in seconds for each run, spent adaptively on the temperatures that find the most unique tests per second; --runs then caps the number of models. 0 disables it.", default=0)
+    parser.add_argument("--temperatures", type=float, nargs="+", required=False,
+                        help="The temperatures to choose from when a budget is given.", default=[0.2, 0.4, 0.6, 0.8, 1.0])
     args = parser.parse_args()
     NSDI = args.test
     if args.module == "cname":
-        cname_match_check(args.runs, args.timeout)
+        cname_match_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "dname":
-        dname_match_check(args.runs, args.timeout)
+        dname_match_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "wildcard":
-        wildcard_match_check(args.runs, args.timeout)
+        wildcard_match_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "ipv4":
-        ipv4_match_check(args.runs, args.timeout)
+        ipv4_match_check(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "full_lookup":
-        full_query_lookup(args.runs, args.timeout)
+        full_query_lookup(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "loop_count":
-        loop_count(args.runs, args.timeout)
+        loop_count(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "rcode":
-        return_code_lookup(args.runs, args.timeout)
+        return_code_lookup(args.runs, args.timeout, args.budget, args.temperatures)
     elif args.module == "authoritative":
-        authoritative_lookup(args.runs, args.timeout)
+        authoritative_lookup(args.runs, args.timeout, args.budget, args.temperatures)
     else:
         print("Invalid module selected.")
\ No newline at end of file
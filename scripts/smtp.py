@@ -58,7 +58,7 @@ def BFS(transition_dict, target_state):
     return None
 
 
-def server_check(runs, timeout):
+def server_check(runs, timeout, budget=0, temperatures=None):
     
     state = ast.Enum("State", ["INITIAL", "HELO_SENT", "EHLO_SENT", "MAIL_FROM_RECEIVED", "RCPT_TO_RECEIVED", "DATA_RECEIVED", "QUITTED"])
 
@@ -81,7 +81,7 @@ def server_check(runs, timeout):
     g.Node(smtp_server_model)
 
     output_dir = output_dir_common / "SMTP"
-    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout)
+    inputs = run(g, k=runs, debug=output_dir, timeout_sec=timeout, budget_sec=budget, temperatures=temperatures)
 
     ## Save the test cases
     test_dir = output_dir
@@ -184,9 +184,13 @@ if __name__ == "__main__":
                         help="Number of runs to generate inputs for.", default=10)
     parser.add_argument("--timeout", type=int, required=False,
                         help="Timeout in seconds for each run.", default=300)
+    parser.add_argument("--budget", type=float, required=False,
+                        help="Total time in seconds for each run, spent adaptively on the temperatures that find the most unique tests per second; --runs then caps the number of models. 0 disables it.", default=0)
+    parser.add_argument("--temperatures", type=float, nargs="+", required=False,
+                        help="The temperatures to choose from when a budget is given.", default=[0.2, 0.4, 0.6, 0.8, 1.0])
     args = parser.parse_args()
     # NSDI = args.nsdi
     if args.module == "server":
-        server_check(args.runs, args.timeout)
+        server_check(args.runs, args.timeout, args.budget, args.temperatures)
     else:
         print("Invalid module selected.")
\ No newline at end of file
@@ -1,3 +1,4 @@
+import operator
 import uuid
 from ast import NodeVisitor
 from typing import List, Union, Any, Dict, Callable
@@ -113,6 +114,14 @@ class Expr(object):
         """
         return Evaluator(assignment).visit(expr)
 
+    @staticmethod
+    def compile(expr, names: List[str]) -> Callable[[tuple], bool]:
+        """
+        Compile an Eywa expression into a Python function that evaluates it
+        given a tuple of values for the named parameters.
+        """
+        return PredicateCompiler.compile(expr, names)
+
     @staticmethod
     def convert(other):
         """
@@ -380,6 +389,96 @@ class Evaluator(NodeVisitor):
         raise Exception(f'Unknown binary operator: {node.op}')
 
 
+class PredicateCompiler(NodeVisitor):
+    """
+    A class that compiles an Eywa Expression into nested Python closures.
+    Parameters are read by position from a tuple of values and the element
+    variables of array quantifiers live in a per-call frame, so evaluating
+    the result allocates nothing per array element.
+    """
+
+    COMPARISONS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '>': operator.gt,
+        '<': operator.lt,
+        '>=': operator.ge,
+        '<=': operator.le,
+        '+': operator.add,
+        '-': operator.sub,
+    }
+
+    @staticmethod
+    def compile(expr, names: List[str]) -> Callable[[tuple], bool]:
+        """
+        Compile an expression over the named parameters.
+        """
+        compiler = PredicateCompiler(names)
+        body = compiler.visit(expr)
+        slots = compiler.slots
+        if slots == 0:
+            return lambda values: body(values, None)
+        return lambda values: body(values, [None] * slots)
+
+    def __init__(self, names: List[str]):
+        self.positions = {name: i for (i, name) in enumerate(names)}
+        self.bound = {}
+        self.slots = 0
+
+    def visit_Var(self, node):
+        if node.parameter_name in self.bound:
+            slot = self.bound[node.parameter_name]
+            return lambda values, frame: frame[slot]
+        i = self.positions[node.parameter_name]
+        return lambda values, frame: values[i]
+
+    def visit_Const(self, node):
+        constant = node.constant
+        return lambda values, frame: constant
+
+    def visit_Not(self, node):
+        expr = self.visit(node.expr)
+        return lambda values, frame: not expr(values, frame)
+
+    def visit_Match(self, node):
+        fullmatch = node.regex.matcher().fullmatch
+        expr = self.visit(node.expr)
+        return lambda values, frame: fullmatch(expr(values, frame)) is not None
+
+    def visit_Field(self, node):
+        expr = self.visit(node.expr)
+        field = node.field
+        return lambda values, frame: expr(values, frame)[field]
+
+    def visit_Forall(self, node):
+        array = self.visit(node.array_expr)
+        slot = self.slots
+        self.slots += 1
+        name = f'forall{slot}'
+        self.bound[name] = slot
+        body = self.visit(node.invariant(Var(Type.inner(node.array_expr.type.element_type), name)))
+
+        def forall(values, frame):
+            for element in array(values, frame):
+                frame[slot] = element
+                if not body(values, frame):
+                    return False
+            return True
+        return forall
+
+    def visit_Binop(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if node.op == '&':
+            return lambda values, frame: left(values, frame) and right(values, frame)
+        if node.op == '|':
+            return lambda values, frame: left(values, frame) or right(values, frame)
+        if node.op not in PredicateCompiler.COMPARISONS:
+            raise Exception(f'Unknown binary operator: {node.op}')
+        op = PredicateCompiler.COMPARISONS[node.op]
+        return lambda values, frame: op(left(values, frame), right(values, frame))
+
+
 class HasMatch(NodeVisitor):
     """
     A class that checks if an Eywa Expression has a match expression.
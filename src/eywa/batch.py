@@ -0,0 +1,303 @@
+from ast import NodeVisitor
+from typing import Iterator, List
+
+from eywa.ast import *
+from eywa.ktest import KTest
+
+
+NUMPY_FORMATS = {'?': '?', 'B': 'u1', 'H': '<u2', 'I': '<u4', 'Q': '<u8'}
+
+
+def numpy_available() -> bool:
+    """
+    Returns whether NumPy can be imported, which the batch filter needs.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+class Column:
+    """
+    A column of leaf values of one Eywa type across a batch of tests.
+    """
+
+    def __init__(self, type: Type, values):
+        self.type = type
+        self.values = values
+
+
+class Unsupported(Exception):
+    """
+    Raised for an expression that cannot be evaluated column-wise.
+    """
+    pass
+
+
+class ColumnLayout(NodeVisitor):
+    """
+    A class that mirrors an Eywa type with the indices of its leaves in the
+    decoding plan, visiting leaves in the same order as DecoderBuilder.
+    Arrays become lists, structs dicts and strings a ('string', indices)
+    pair, since strings are never evaluated column-wise.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def _leaf(self, node):
+        self.count += 1
+        return (node, self.count - 1)
+
+    def visit_Bool(self, node): return self._leaf(node)
+    def visit_Char(self, node): return self._leaf(node)
+    def visit_Int(self, node): return self._leaf(node)
+    def visit_Enum(self, node): return self._leaf(node)
+
+    def visit_String(self, node):
+        start = self.count
+        self.count += node.maxsize
+        return ('string', range(start, self.count))
+
+    def visit_Array(self, node):
+        return [self.visit(node.element_type) for _ in range(0, node.maxsize)]
+
+    def visit_Struct(self, node):
+        return {field_name: self.visit(field) for (field_name, field) in node.fields.items()}
+
+    def visit_Alias(self, node):
+        return self.visit(node.type)
+
+
+class MaskEvaluator(NodeVisitor):
+    """
+    A class that evaluates an Eywa Expression over a structured NumPy array
+    of tests, returning a boolean mask with one entry per test.
+    """
+
+    def __init__(self, np, rows, layouts):
+        self.np = np
+        self.rows = rows
+        self.layouts = layouts
+
+    def _value(self, layout):
+        if isinstance(layout, tuple) and layout[0] != 'string':
+            (type, i) = layout
+            values = self.rows[f'f{i}']
+            if isinstance(type, Int):
+                # widen so that arithmetic does not wrap around like the
+                # unsigned columns would; 64-bit values become Python ints.
+                values = values.astype(self.np.int64 if values.dtype.itemsize < 8 else object)
+            return Column(type, values)
+        if isinstance(layout, tuple):
+            raise Unsupported('string columns')
+        return layout
+
+    def visit_Var(self, node):
+        if node.parameter_name not in self.layouts:
+            raise Unsupported(f'unknown variable {node.parameter_name}')
+        return self._value(self.layouts[node.parameter_name])
+
+    def visit_Const(self, node):
+        return node.constant
+
+    def visit_Not(self, node):
+        return ~self._mask(self.visit(node.expr))
+
+    def visit_Match(self, node):
+        raise Unsupported('regular expression match')
+
+    def visit_Field(self, node):
+        value = self.visit(node.expr)
+        if not isinstance(value, dict):
+            raise Unsupported('field of a non-struct')
+        return self._value(value[node.field])
+
+    def visit_Forall(self, node):
+        array = self.visit(node.array_expr)
+        if not isinstance(array, list):
+            raise Unsupported('quantifier over a non-array')
+        name = f'forall{len(self.layouts)}'
+        invariant = node.invariant(Var(Type.inner(node.array_expr.type.element_type), name))
+        mask = self.np.ones(len(self.rows), dtype=bool)
+        for element in array:
+            self.layouts[name] = element
+            mask &= self._mask(self.visit(invariant))
+        self.layouts.pop(name, None)
+        return mask
+
+    def visit_Binop(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if node.op == '&':
+            return self._mask(left) & self._mask(right)
+        if node.op == '|':
+            return self._mask(left) | self._mask(right)
+        (left, right) = (self._operand(left, right), self._operand(right, left))
+        if node.op == '==':
+            return left == right
+        elif node.op == '!=':
+            return left != right
+        elif node.op == '>':
+            return left > right
+        elif node.op == '<':
+            return left < right
+        elif node.op == '>=':
+            return left >= right
+        elif node.op == '<=':
+            return left <= right
+        elif node.op == '+':
+            return left + right
+        elif node.op == '-':
+            return left - right
+        raise Exception(f'Unknown binary operator: {node.op}')
+
+    def _operand(self, value, other):
+        """
+        Converts a column or a constant into something NumPy can compare,
+        translating enum and char constants into the integers KLEE stores.
+        """
+        if isinstance(value, Column):
+            return value.values
+        if isinstance(value, (list, dict)):
+            raise Unsupported('comparison of arrays or structs')
+        if isinstance(other, Column):
+            type = Type.inner(other.type)
+            if isinstance(type, Enum):
+                if value not in type.values:
+                    raise Unsupported(f'unknown enum value {value}')
+                return type.values.index(value)
+            if isinstance(type, Char) and isinstance(value, str):
+                return ord(value)
+        if isinstance(value, str):
+            raise Unsupported('string constant')
+        return value
+
+    def _mask(self, value):
+        if isinstance(value, Column):
+            if isinstance(Type.inner(value.type), (Char, Enum)):
+                # a decoded char or enum value is a non-empty string.
+                raise Unsupported('char or enum used as a condition')
+            return value.values != 0
+        if isinstance(value, (list, dict)):
+            raise Unsupported('array or struct used as a condition')
+        if isinstance(value, self.np.ndarray):
+            return value.astype(bool) if value.dtype != bool else value
+        return self.np.full(len(self.rows), bool(value))
+
+
+def conjuncts(expr: Expr) -> List[Expr]:
+    """
+    Splits an expression into the list of its top-level conjuncts.
+    """
+    if isinstance(expr, Binop) and expr.op == '&':
+        return conjuncts(expr.left) + conjuncts(expr.right)
+    return [expr]
+
+
+class BatchFilter:
+    """
+    Decodes and validates KLEE tests a batch at a time. The well-formed tests
+    of a batch are loaded into a NumPy structured array with one column per
+    leaf of the decoding plan, and every conjunct of the precondition that
+    can be evaluated column-wise is reduced to a mask over the whole batch.
+    Only the tests that survive the mask are converted to Python values, and
+    the remaining conjuncts (for example regular expression matches) are
+    checked on them with the scalar compiled predicate.
+    """
+
+    def __init__(self, plan, parameters: List[Parameter], precondition: Union[Expr, None], has_valid_input_param: bool):
+        import numpy as np
+        self.np = np
+        self.plan = plan
+        self.has_valid_input_param = has_valid_input_param
+        self.dtype = np.dtype([(f'f{i}', NUMPY_FORMATS[format])
+                               for (i, format) in enumerate(plan.struct.format.lstrip('<'))])
+        builder = ColumnLayout()
+        self.layouts = {}
+        for parameter in parameters:
+            self.layouts[parameter.name] = builder.visit(parameter.type)
+        if has_valid_input_param:
+            self.flag = builder.count
+            builder.count += 1
+        self.names = [parameter.name for parameter in parameters]
+        self.vectorized = []
+        self.residual_exprs = []
+        for conjunct in ([] if precondition is None else conjuncts(precondition)):
+            if Expr.has_match(conjunct):
+                self.residual_exprs.append(conjunct)
+            else:
+                self.vectorized.append(conjunct)
+        self.precondition = None if precondition is None else Expr.compile(precondition, self.names)
+        self._compile_residual()
+
+    def _compile_residual(self):
+        self.residual = None
+        if self.residual_exprs:
+            expr = self.residual_exprs[0]
+            for conjunct in self.residual_exprs[1:]:
+                expr = expr & conjunct
+            self.residual = Expr.compile(expr, self.names)
+
+    def _scalar(self, klee_input):
+        """
+        Validates one decoded test exactly as KleeOracle does without batching.
+        """
+        if self.precondition is not None and not self.precondition(klee_input):
+            return None
+        if self.has_valid_input_param:
+            if klee_input[-1]:
+                return None
+            return klee_input[:-1]
+        return klee_input
+
+    def _mask(self, rows):
+        np = self.np
+        mask = np.ones(len(rows), dtype=bool)
+        if self.has_valid_input_param:
+            mask &= ~rows[f'f{self.flag}']
+        vectorized = []
+        for conjunct in self.vectorized:
+            try:
+                evaluator = MaskEvaluator(np, rows, dict(self.layouts))
+                mask &= evaluator._mask(evaluator.visit(conjunct))
+                vectorized.append(conjunct)
+            except Unsupported:
+                # checked on the surviving tests from now on.
+                self.residual_exprs.append(conjunct)
+        if len(vectorized) != len(self.vectorized):
+            self.vectorized = vectorized
+            self._compile_residual()
+        return mask
+
+    def filter(self, records: List[KTest]) -> Iterator[tuple]:
+        """
+        Yields the valid inputs among a batch of KLEE tests, in order.
+        """
+        good = []
+        results = [None] * len(records)
+        for (i, record) in enumerate(records):
+            objects = self.plan._objects(record)
+            data = b''.join(objects)
+            if len(objects) == self.plan.count and len(data) == self.plan.struct.size:
+                good.append((i, data))
+            else:
+                results[i] = self._scalar(self.plan.decode(record))
+        if good:
+            rows = self.np.frombuffer(b''.join(data for (_, data) in good), dtype=self.dtype)
+            mask = self._mask(rows)
+            survivors = rows[mask].tolist()
+            indices = [i for ((i, _), keep) in zip(good, mask.tolist()) if keep]
+            for (i, values) in zip(indices, survivors):
+                klee_input = self.plan._build(values)
+                if None in klee_input:
+                    results[i] = self._scalar(klee_input)
+                    continue
+                if self.residual is not None and not self.residual(klee_input):
+                    continue
+                results[i] = klee_input[:-1] if self.has_valid_input_param else klee_input
+        for klee_input in results:
+            if klee_input is not None:
+                yield klee_input
@@ -0,0 +1,433 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Iterator, List, Union
+
+
+def default_cache_dir() -> str:
+    """
+    Returns the root directory used for Eywa's on-disk caches. It can be
+    overridden with the EYWA_CACHE_DIR environment variable.
+    """
+    directory = os.environ.get("EYWA_CACHE_DIR")
+    if directory:
+        return directory
+    return os.path.join(os.path.expanduser("~"), ".cache", "eywa")
+
+
+def content_key(*parts: Any) -> str:
+    """
+    Computes a SHA-256 content address for a JSON-serializable list of parts.
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    A content-addressed on-disk cache mapping hex keys to byte strings.
+
+    Entries are stored one per file under a two-character fan-out directory.
+    The modification time of an entry is refreshed on every hit, so when the
+    total size exceeds max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        """
+        Returns the cached value for the key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        """
+        Atomically stores a value for the key and evicts old entries if the
+        cache has grown past its size bound.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        with self._lock:
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+            if self._size is None:
+                self._size = self._disk_size()
+            else:
+                self._size += len(value) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry
+
+    def _disk_size(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _evict(self) -> None:
+        """
+        Removes least recently used entries until the cache is back under
+        90% of its size bound.
+        """
+        entries = []
+        for entry in self._entries():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        target = int(self.max_bytes * 0.9)
+        for (_, entry_size, path) in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except OSError:
+                pass
+        self._size = size
+
+
+class ImplementationStore(DiskCache):
+    """
+    A persistent store of the implementation the LLM generated for each
+    node of a dependency graph, keyed by the node's fingerprint. When a
+    graph is synthesized again, only the nodes whose fingerprint changed
+    are sent to the LLM; the others are rebuilt from the store.
+    """
+
+    _shared = None
+
+    def __init__(self, directory: Union[str, None] = None, max_bytes: int = 64 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), "implementations")
+        super().__init__(directory, max_bytes=max_bytes)
+
+    @staticmethod
+    def shared():
+        """
+        Returns the process-wide implementation store, or None when it has
+        been disabled by setting EYWA_NODE_STORE=0, or EYWA_LLM_CACHE=0 so
+        that every node is sent to the LLM.
+        """
+        for variable in ("EYWA_NODE_STORE", "EYWA_LLM_CACHE"):
+            if os.environ.get(variable, "1").lower() in ("0", "off", "false"):
+                return None
+        if ImplementationStore._shared is None:
+            ImplementationStore._shared = ImplementationStore()
+        return ImplementationStore._shared
+
+    def lookup(self, fingerprint: str) -> Union[str, None]:
+        value = self.get(fingerprint)
+        return None if value is None else value.decode("utf-8")
+
+    def store(self, fingerprint: str, implementation: str) -> None:
+        self.put(fingerprint, implementation.encode("utf-8"))
+
+
+class SeedStore:
+    """
+    A persistent store of KLEE tests used to seed later KLEE runs, grouped
+    by input schema: models whose KLEE mains create the same symbolic
+    objects can replay each other's tests. Each schema keeps its newest
+    max_seeds distinct tests, one .ktest file each.
+    """
+
+    _shared = None
+
+    def __init__(self, directory: Union[str, None] = None, max_seeds: int = 256):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), "seeds")
+        self.directory = directory
+        self.max_seeds = max_seeds
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        """
+        Returns the process-wide seed store, or None when it has been
+        disabled by setting EYWA_SEEDS=0.
+        """
+        if os.environ.get("EYWA_SEEDS", "1").lower() in ("0", "off", "false"):
+            return None
+        if SeedStore._shared is None:
+            SeedStore._shared = SeedStore()
+        return SeedStore._shared
+
+    def _entries(self, schema: str):
+        directory = os.path.join(self.directory, schema)
+        if not os.path.isdir(directory):
+            return []
+        entries = [entry for entry in os.scandir(directory) if entry.name.endswith(".ktest")]
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime)
+
+    def seeds(self, schema: str) -> List[bytes]:
+        """
+        Returns the stored tests for the schema, oldest first.
+        """
+        seeds = []
+        with self._lock:
+            for entry in self._entries(schema):
+                try:
+                    with open(entry.path, "rb") as f:
+                        seeds.append(f.read())
+                except OSError:
+                    pass
+        return seeds
+
+    def add(self, schema: str, tests: List[bytes]) -> None:
+        """
+        Stores tests for the schema and drops the oldest ones beyond max_seeds.
+        """
+        directory = os.path.join(self.directory, schema)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            for test in tests:
+                path = os.path.join(directory, hashlib.sha256(test).hexdigest()[:32] + ".ktest")
+                if os.path.exists(path):
+                    os.utime(path)
+                    continue
+                fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(test)
+                os.replace(temp_path, path)
+            entries = self._entries(schema)
+            for entry in entries[:max(0, len(entries) - self.max_seeds)]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class ResultStore:
+    """
+    A persistent SQLite store of decoded KLEE results, keyed by the hash of
+    the program and the KLEE command line (which includes the max-time).
+    Entries older than max_age_sec are dropped, and the least recently used
+    entries are evicted once the stored results exceed max_bytes.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path: Union[str, None] = None, max_age_sec: float = 30 * 24 * 3600, max_bytes: int = 1024 * 1024 * 1024):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "results.sqlite")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_age_sec = max_age_sec
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, count INTEGER)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tests (key TEXT, idx INTEGER, data BLOB)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS tests_key ON tests (key, idx)")
+
+    @staticmethod
+    def shared():
+        """
+        Returns the process-wide result store, or None when it has been
+        disabled by setting EYWA_RESULT_STORE=0.
+        """
+        if os.environ.get("EYWA_RESULT_STORE", "1").lower() in ("0", "off", "false"):
+            return None
+        with ResultStore._shared_lock:
+            if ResultStore._shared is None:
+                ResultStore._shared = ResultStore()
+            return ResultStore._shared
+
+    @staticmethod
+    def key(program: str, command: str, decoder: str = "") -> str:
+        """
+        Returns the key for the results of running command on program and
+        decoding the tests with the given decoder version, since the store
+        holds decoded inputs.
+        """
+        program_hash = hashlib.sha256(program.encode("utf-8")).hexdigest()
+        return content_key(program_hash, command, decoder)
+
+    def get(self, key: str) -> Union[List[Any], None]:
+        """
+        Returns the stored tests for the key, or None if there are none.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[0] > self.max_age_sec:
+                return None
+            rows = self._db.execute(
+                "SELECT data FROM tests WHERE key = ? ORDER BY idx", (key,)).fetchall()
+            with self._db:
+                self._db.execute(
+                    "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return [pickle.loads(data) for (data,) in rows]
+
+    def iter(self, key: str) -> Union[Iterator[Any], None]:
+        """
+        Like get(), but returns an iterator that reads the stored tests in
+        batches instead of loading all of them at once.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[0] > self.max_age_sec:
+                return None
+            with self._db:
+                self._db.execute(
+                    "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        def tests():
+            idx = -1
+            while True:
+                with self._lock:
+                    rows = self._db.execute(
+                        "SELECT idx, data FROM tests WHERE key = ? AND idx > ? ORDER BY idx LIMIT 1000",
+                        (key, idx)).fetchall()
+                if not rows:
+                    return
+                for (idx, data) in rows:
+                    yield pickle.loads(data)
+        return tests()
+
+    def put(self, key: str, tests: List[Any]) -> None:
+        """
+        Replaces the stored tests for the key and evicts old entries.
+        """
+        writer = self.writer(key)
+        for test in tests:
+            writer.add(test)
+        writer.commit()
+
+    def writer(self, key: str):
+        """
+        Returns a ResultWriter that stores tests for the key incrementally.
+        """
+        return ResultWriter(self, key)
+
+    def _append(self, pending: str, start: int, tests: List[Any]) -> int:
+        blobs = [(pending, start + i, pickle.dumps(test)) for (i, test) in enumerate(tests)]
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO tests (key, idx, data) VALUES (?, ?, ?)", blobs)
+        return sum(len(blob[2]) for blob in blobs)
+
+    def _commit(self, key: str, pending: str, size: int, count: int) -> None:
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._delete(key)
+                self._db.execute(
+                    "UPDATE tests SET key = ? WHERE key = ?", (key, pending))
+                self._db.execute(
+                    "INSERT INTO results (key, created, accessed, size, count) VALUES (?, ?, ?, ?, ?)",
+                    (key, now, now, size, count))
+            self._evict(now)
+
+    def _abort(self, pending: str) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM tests WHERE key = ?", (pending,))
+
+    def invalidate(self, key: str) -> None:
+        """
+        Removes the stored tests for the key.
+        """
+        with self._lock:
+            with self._db:
+                self._delete(key)
+
+    def _delete(self, key: str) -> None:
+        self._db.execute("DELETE FROM tests WHERE key = ?", (key,))
+        self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def _evict(self, now: float) -> None:
+        with self._db:
+            expired = self._db.execute(
+                "SELECT key FROM results WHERE created < ?", (now - self.max_age_sec,)).fetchall()
+            for (key,) in expired:
+                self._delete(key)
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for (key, size) in self._db.execute(
+                    "SELECT key, size FROM results ORDER BY accessed").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._delete(key)
+                total -= size
+
+
+class ResultWriter:
+    """
+    Stores the tests of one KLEE run in batches as they are produced. The
+    tests only become visible under their key once commit() is called, so
+    an interrupted run never leaves a partial result behind.
+    """
+
+    def __init__(self, store: ResultStore, key: str, batch: int = 1000):
+        self.store = store
+        self.key = key
+        self.pending = f"pending:{uuid.uuid4().hex}"
+        self.batch = batch
+        self.buffer = []
+        self.count = 0
+        self.size = 0
+
+    def add(self, test: Any) -> None:
+        self.buffer.append(test)
+        if len(self.buffer) >= self.batch:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.buffer:
+            self.size += self.store._append(self.pending, self.count, self.buffer)
+            self.count += len(self.buffer)
+            self.buffer = []
+
+    def commit(self) -> None:
+        self._flush()
+        self.store._commit(self.key, self.pending, self.size, self.count)
+
+    def abort(self) -> None:
+        self.buffer = []
+        self.store._abort(self.pending)
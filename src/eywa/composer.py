@@ -1,10 +1,38 @@
+import hashlib
+import itertools
+import math
 import os
+import random
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from eywa.oracles import KleeOracle
 from eywa.ast import *
-from collections import defaultdict
+from collections import defaultdict, deque
+from eywa.cache import ImplementationStore
 from eywa.composition import *
 from eywa.regex import *
+from eywa.trace import in_context, traced
+
+def sample_combinations(sizes: List[int], rng: random.Random):
+    """
+    Yields distinct choices of one sample per node, first the first sample
+    of every node and then the other combinations in random order.
+    """
+    total = math.prod(sizes)
+    if total <= 4096:
+        combinations = list(itertools.product(*(range(size) for size in sizes)))
+        rest = combinations[1:]
+        rng.shuffle(rest)
+        yield combinations[0]
+        yield from rest
+        return
+    seen = set()
+    combination = tuple(0 for _ in sizes)
+    while True:
+        if combination not in seen:
+            seen.add(combination)
+            yield combination
+        combination = tuple(rng.randrange(size) for size in sizes)
 
 class DependencyGraph:
     def __init__(self):
@@ -15,6 +43,12 @@ class DependencyGraph:
         self.node_to_model = {}
         self.nodes = 0
         self.oracle = None
+        self.has_regex_module = False
+        # the topological order, the position of each node in it and the
+        # levels, computed on demand and reset whenever the graph changes.
+        self._topo_order = None
+        self._position = None
+        self._levels = None
     
         
     def add_node(self, model):
@@ -23,6 +57,9 @@ class DependencyGraph:
         self.model_to_node[model] = self.nodes
         self.node_to_model[self.nodes] = model
         self.nodes += 1
+        if type(model).__name__ == 'RegexModule':
+            self.has_regex_module = True
+        self._topo_order = None
         
         
     def add_edge(self, model1, model2):
@@ -33,6 +70,7 @@ class DependencyGraph:
             
         self.graph[self.model_to_node[model1]].append(self.model_to_node[model2])
         self.dependencies[self.model_to_node[model2]].append(self.model_to_node[model1])
+        self._topo_order = None
         
 
     def Edge(self, model1, model2):
@@ -57,31 +95,55 @@ class DependencyGraph:
         # creates a new node in the dependency graph
         self.add_node(model)
     
-    def topologicalSortUtil(self, v, visited, sorted_order):
-        visited[v] = True
-        
-        for i in self.graph[v]:
-            if not visited[i]:
-                self.topologicalSortUtil(i, visited, sorted_order)
-            
-        sorted_order.append(v)
-                
-    
     def topologicalSort(self):
-        sorted_order = []
-        visited = [False for i in range(self.nodes)]
-        
-        for i in range(self.nodes):
-            if not visited[i]:
-                self.topologicalSortUtil(i, visited, sorted_order)
-        
-        sorted_order.reverse()
-        return sorted_order
+        """
+        Returns the nodes in dependency order, every node after the nodes it
+        depends on. The order is computed iteratively with Kahn's algorithm
+        and cached until the graph changes. Raises an exception if the
+        graph has a cycle.
+        """
+        if self._topo_order is None:
+            indegree = [len(self.dependencies[node]) for node in range(self.nodes)]
+            level = [0 for _ in range(self.nodes)]
+            ready = deque(node for node in range(self.nodes) if indegree[node] == 0)
+            order = []
+            while ready:
+                node = ready.popleft()
+                order.append(node)
+                for dependent in self.graph[node]:
+                    level[dependent] = max(level[dependent], level[node] + 1)
+                    indegree[dependent] -= 1
+                    if indegree[dependent] == 0:
+                        ready.append(dependent)
+            if len(order) < self.nodes:
+                cycle = [self.node_to_model[node].name for node in range(self.nodes) if indegree[node] > 0]
+                raise Exception(f'The dependency graph has a cycle through {cycle}')
+            levels = [[] for _ in range(max(level, default=-1) + 1)]
+            for node in order:
+                levels[level[node]].append(node)
+            self._topo_order = order
+            self._position = {node: i for (i, node) in enumerate(order)}
+            self._levels = levels
+        return list(self._topo_order)
 
-    def Synthesize(self, temperature: float = 0.6):
-        return self.synthesize(temperature=temperature)
+    def levels(self):
+        """
+        Returns the models in batches of independent nodes: the first batch
+        has no dependencies, and every node only depends on nodes of
+        earlier batches, so the nodes of a batch can be handled in parallel.
+        """
+        self.topologicalSort()
+        return [[self.node_to_model[node] for node in level] for level in self._levels]
+
+    def Synthesize(self, temperature: float = 0.6, slot: int = 0, max_in_flight: int = 4, regex_backend: str = 'dfa'):
+        return self.synthesize(temperature=temperature, slot=slot, max_in_flight=max_in_flight, regex_backend=regex_backend)
         
-    def synthesize(self, filter_functions: List = [], temperature: float = 0.6):
+    def _jobs(self, filter_functions: List, **kwargs):
+        """
+        Returns the topological order of the nodes, the model and the
+        run_wrapper_model arguments of each node in that order, the index
+        of the main node and the filter functions.
+        """
         topo_order = self.topologicalSort()
         print(self.graph)
         print(self.dependencies)
@@ -90,49 +152,121 @@ class DependencyGraph:
         if len(self.filter_functions) > 0:
             filter_functions = self.filter_functions
         
-        oracles = []
-        main_oracle = None
-        filter_oracles = []
+        jobs = []
+        main_index = None
         for i, node in enumerate(topo_order):
             model = self.node_to_model[node]
             dependencies = [self.node_to_model[dep] for dep in self.dependencies[node]]
     
             if len(self.graph[node]) == 0 and self.node_to_model[node] not in filter_functions:
                 if len(filter_functions) == 0:
-                    oracle = run_wrapper_model(model, function_prototypes=dependencies, partial=False, temperature=temperature)
+                    job = dict(function_prototypes=dependencies, partial=False, **kwargs)
                 else:
-                    oracle = run_wrapper_model(model, function_prototypes=dependencies, filter_functions=filter_functions, partial=False, temperature=temperature)
-                main_oracle = oracle
+                    job = dict(function_prototypes=dependencies, filter_functions=filter_functions, partial=False, **kwargs)
+                main_index = i
             else:
-                oracle = run_wrapper_model(model, function_prototypes=dependencies, temperature=temperature)
-                # print("Generated oracle for model:", model.name)
-                if self.node_to_model[node] in filter_functions:
-                    filter_oracles.append(oracle)
-            
-            oracles.append(oracle)
+                job = dict(function_prototypes=dependencies, **kwargs)
+            jobs.append((model, job))
+        return (topo_order, jobs, main_index, filter_functions)
+
+    @traced("synthesize")
+    def synthesize(self, filter_functions: List = [], temperature: float = 0.6, slot: int = 0, max_in_flight: int = 4, regex_backend: str = 'dfa'):
+        """
+        Synthesizes a model for every node and splices them into a single program.
+        The prompt for a node only depends on the signatures of its dependencies,
+        so up to max_in_flight LLM requests are issued concurrently and the
+        splicing is done once all of the completions have arrived.
+        regex_backend selects how regex matches are compiled to C ('dfa'
+        or 'backtracking'). Nodes whose fingerprint (see
+        KleeOracle.fingerprint) is unchanged since an earlier synthesis
+        reuse the stored implementation instead of querying the LLM.
+        """
+        store = ImplementationStore.shared()
+        (topo_order, jobs, main_index, filter_functions) = self._jobs(
+            filter_functions, temperature=temperature, slot=slot, regex_backend=regex_backend, store=store)
+        
+        with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+            futures = [executor.submit(in_context(run_wrapper_model), model, **kwargs) for (model, kwargs) in jobs]
+            oracles = [future.result() for future in futures]
+        reused = [oracle.name for oracle in oracles if oracle.reused]
+        if len(reused) > 0:
+            print(f"Reused the stored implementations of {len(reused)} of {len(oracles)} nodes:", reused)
+        
+        return self._splice(topo_order, oracles, main_index, filter_functions)
+
+    @traced("synthesize.samples")
+    def synthesize_samples(self, n: int, k: int, filter_functions: List = [], temperature: float = 0.6, max_in_flight: int = 4, regex_backend: str = 'dfa', seed: int = 0):
+        """
+        Synthesizes up to k distinct programs from n samples per node. The
+        samples of a node are drawn in one batched LLM request, and the
+        programs are assembled from combinations of the samples of every
+        node, starting with the first sample of each, until k programs
+        with different source code have been found or the combinations
+        run out. k programs therefore cost n LLM samples per node instead
+        of k synthesized graphs.
+        """
+        store = ImplementationStore.shared()
+        (topo_order, jobs, main_index, filter_functions) = self._jobs(
+            filter_functions, temperature=temperature, slot=0, regex_backend=regex_backend)
+
+        def sample(model, kwargs):
+            if type(model).__name__ == 'RegexModule':
+                return [None]
+            oracle = KleeOracle(model, kwargs["function_prototypes"], temperature=temperature, regex_backend=regex_backend)
+            return oracle.sample_completions(n, store)
+
+        with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+            futures = [executor.submit(in_context(sample), model, kwargs) for (model, kwargs) in jobs]
+            samples = [future.result() for future in futures]
+        for ((model, _), completions) in zip(jobs, samples):
+            if len(completions) == 0:
+                raise Exception(f'No completion finished for {model.name}')
+        print("Distinct samples per node:", {model.name: len(completions) for ((model, _), completions) in zip(jobs, samples)})
+
+        programs = []
+        seen = set()
+        total = math.prod(len(completions) for completions in samples)
+        combinations = sample_combinations([len(completions) for completions in samples], random.Random(seed))
+        for (attempt, combination) in enumerate(combinations):
+            if len(programs) == k or attempt == min(total, 20 * k):
+                break
+            oracles = [run_wrapper_model(model, completion=completions[choice], **kwargs)
+                       for ((model, kwargs), completions, choice) in zip(jobs, samples, combination)]
+            main_oracle = self._splice(topo_order, oracles, main_index, filter_functions)
+            program = hashlib.sha256(main_oracle.implementation.encode("utf-8")).hexdigest()
+            if program not in seen:
+                seen.add(program)
+                programs.append(main_oracle)
+        print(f"Assembled {len(programs)} distinct programs from {total} combinations")
+        return programs
+
+    def _splice(self, topo_order, oracles, main_index, filter_functions):
+        """
+        Splices the implementations of the nodes, given in topological
+        order, into the program of the main node and returns its oracle.
+        """
+        main_oracle = oracles[main_index] if main_index is not None else None
+        filter_models = set(filter_functions)
+        filter_oracles = [oracle for (node, oracle) in zip(topo_order, oracles)
+                          if self.node_to_model[node] in filter_models]
+        position = self._position
             
         for i, oracle in enumerate(oracles):
             node = topo_order[i]
             if len(self.dependencies[node]) > 0:
+                implementations = []
                 for j, dep in enumerate(self.dependencies[node]):
-                    dep_index = topo_order.index(dep)
-                    oracle.implementation = replace_wrapper_code(oracle.implementation, oracles[dep_index].implementation, oracle.function_declares[j])
+                    implementations.append((oracles[position[dep]].implementation, oracle.function_declares[j]))
+                oracle.implementation = compose_dependencies(oracle.implementation, implementations)
 
         # print("Number of filter functions:", len(filter_oracles))
         for filter_oracle in filter_oracles:
             main_oracle.implementation = insert_function_definition(main_oracle.implementation, filter_oracle.implementation)
         
         # Add regex implementation if any regex modules exist (only once)
-        has_regex_module = False
-        for node in topo_order:
-            model = self.node_to_model[node]
-            if type(model).__name__ == 'RegexModule':
-                has_regex_module = True
-                break
-        
-        if has_regex_module:
+        if self.has_regex_module:
             # Get the regex implementation from a temporary oracle
             regex_impl = main_oracle._regex_impl()
             main_oracle.implementation = insert_regex_impl(main_oracle.implementation, regex_impl)
         
-        return main_oracle
\ No newline at end of file
+        return main_oracle
@@ -1,230 +1,305 @@
 import eywa.oracles as oracles
 import json
 import re
+from functools import lru_cache
+from eywa.trace import span, traced
 
-def find_all_function_definitions(c_code):
-    # Split the C code into lines for easy line number tracking
-    pattern = re.compile(r'\b([a-zA-Z_][a-zA-Z0-9_]*)\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*\(([^)]*)\)\s*\{')
-    
-    functions = re.findall(pattern, c_code)
-    lines = c_code.split("\n")
-    k = 0
-    flag = False
-    d = dict()
-    
-    if len(functions) == 0: return d
-    
-    for i, line in enumerate(lines):
-        f_dec = functions[k][0] + ' ' + functions[k][1] + '(' + functions[k][2] + ') {'
-        # print(f_dec)
-        if line.startswith(f_dec):
-            flag = True           
-            d[f_dec] = (i,)
-        if line.rstrip().startswith('}') and flag:
-            d[f_dec] += (i,)
-            flag = False
-            k += 1
-        if k == len(functions):
-            break
-    
-    return d
-
-def remove_function_definition(c_code, rngs):
-    new_c_code = ""
+_TOKEN = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<literal>"(?:\\.|[^"\\\n])*"?|'(?:\\.|[^'\\\n])*'?)
+  | (?P<directive>\#(?:\\\r?\n|[^\n])*)
+  | (?P<word>\w+)
+  | (?P<space>\s+)
+  | (?P<punct>.)
+""", re.S | re.X)
+
+class CDeclaration:
+    """
+    A top-level item of a C program: a preprocessor directive, a typedef,
+    a prototype, another declaration or a function definition, spanning
+    code[start:end] of the program it was found in.
+    """
+
+    def __init__(self, kind, name, start, end):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f'CDeclaration({self.kind}, {self.name}, {self.start}, {self.end})'
+
+class CIndex:
+    """
+    Indexes the top-level declarations of a C program in a single pass of
+    a tokenizer that skips comments and literals and tracks parentheses
+    and braces, so nested blocks, struct bodies and initializers are never
+    mistaken for declarations.
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.declarations = []
+        self.functions = dict()
+        self._scan()
+        for declaration in self.declarations:
+            if declaration.kind == 'function':
+                self.functions.setdefault(declaration.name, declaration)
+
+    def _scan(self):
+        code = self.code
+        start = None
+        depth = 0
+        parens = 0
+        for m in _TOKEN.finditer(code):
+            kind = m.lastgroup
+            if kind == 'space' or kind == 'comment':
+                continue
+            if kind == 'directive':
+                # a directive has to start its line, otherwise the '#' is stray.
+                line = code.rfind('\n', 0, m.start()) + 1
+                if code[line:m.start()].strip() == '':
+                    if start is None:
+                        word = re.match(r'#\s*(\w*)', m.group())
+                        self.declarations.append(CDeclaration('directive', word.group(1), m.start(), m.end()))
+                    continue
+            if start is None:
+                start = m.start()
+                first = None
+                name = None
+                last_word = None
+                prototype = False
+                function = False
+                assign = False
+                last = None
+            token = m.group()
+            if depth > 0:
+                if token == '{':
+                    depth += 1
+                elif token == '}':
+                    depth -= 1
+                    if depth == 0 and function:
+                        self.declarations.append(CDeclaration('function', name, start, m.end()))
+                        start = None
+                continue
+            if kind == 'word':
+                if parens == 0:
+                    first = first or token
+                    last_word = token
+            elif token == '(':
+                if parens == 0 and name is None and not assign:
+                    name = last_word
+                    prototype = True
+                parens += 1
+            elif token == ')':
+                parens = max(0, parens - 1)
+            elif parens > 0:
+                pass
+            elif token == '{':
+                function = prototype and last == ')' and first != 'typedef'
+                depth = 1
+            elif token == '=' or token == '[':
+                if name is None:
+                    name = last_word
+                assign = assign or token == '='
+            elif token == ';':
+                if first == 'typedef':
+                    self.declarations.append(CDeclaration('typedef', last_word, start, m.end()))
+                else:
+                    kind = 'prototype' if prototype and not assign else 'declaration'
+                    self.declarations.append(CDeclaration(kind, name or last_word, start, m.end()))
+                start = None
+            last = token
+        if start is not None:
+            self.declarations.append(CDeclaration('incomplete', None, start, len(code)))
+
+    def header(self):
+        """
+        Returns the declarations before the first prototype or function
+        definition, that is the includes, types and constants.
+        """
+        header = []
+        for declaration in self.declarations:
+            if declaration.kind in ('prototype', 'function'):
+                break
+            header.append(declaration)
+        return header
+
+    def header_end(self):
+        """
+        Returns the offset just after the last typedef of the header, or
+        after its last #include if it has no typedef.
+        """
+        header = self.header()
+        typedefs = [d for d in header if d.kind == 'typedef']
+        if typedefs:
+            return typedefs[-1].end
+        includes = [d for d in header if d.kind == 'directive' and d.name == 'include']
+        return includes[-1].end if includes else 0
+
+    def extent(self, declaration):
+        """
+        Returns the span of a declaration extended over the rest of its
+        last line, so that removing it does not leave a blank line.
+        """
+        end = self.code.find('\n', declaration.end)
+        if end < 0:
+            end = len(self.code)
+        if self.code[declaration.end:end].strip() != '':
+            return (declaration.start, declaration.end)
+        return (declaration.start, min(end + 1, len(self.code)))
+
+@lru_cache(maxsize=256)
+def index_c(code):
+    """
+    Returns the CIndex of a program. Programs are indexed once however many
+    dependents splice them in.
+    """
+    return CIndex(code)
+
+def splice(code, edits):
+    """
+    Applies non-overlapping (start, end, text) replacements to the code in
+    one pass.
+    """
+    pieces = []
     prev = 0
-    c_code = c_code.split("\n")
-    for rng in rngs:
-        # print(c_code[rng[0]])
-        new_c_code = new_c_code + '\n'.join(c_code[prev:rng[0]])
-        prev = rng[1] + 1
-    
-    new_c_code = new_c_code + '\n'.join(c_code[prev:])
-    return new_c_code
+    for (start, end, text) in sorted(edits, key=lambda edit: edit[:2]):
+        pieces.append(code[prev:start])
+        pieces.append(text)
+        prev = end
+    pieces.append(code[prev:])
+    return ''.join(pieces)
+
+def find_all_function_definitions(c_code):
+    """
+    Returns the top-level function definitions of the code by name.
+    """
+    return index_c(c_code).functions
 
+def function_body(index, skip=()):
+    """
+    Returns the code after the includes and typedefs of a program, without
+    the definitions of the functions named in skip.
+    """
+    start = index.header_end()
+    removals = [index.extent(d) + ('',) for d in index.functions.values() if d.name in skip and d.start >= start]
+    return splice(index.code[start:], [(s - start, e - start, text) for (s, e, text) in removals])
+
+@traced("compose.insert_function_definition")
 def insert_function_definition(wrapper_code, function_code):
-    wrapper_code_functions = find_all_function_definitions(wrapper_code)
-    function_code_functions = find_all_function_definitions(function_code)
-    
-    removals = []
-    for func in function_code_functions:
-        if func in wrapper_code_functions:
-            removals.append(wrapper_code_functions[func])
-    removals.sort()
-    wrapper_code = remove_function_definition(wrapper_code, removals)
-    
-    ## Skip the includes and the structs (typedef struct) in function code
-    last_typedef_struct_line = None
-    lines = function_code.split("\n")
-    function_code_typedef_struct_lines = []           
-            
-    for line in lines:
-        if line.startswith("typedef"):
-            function_code_typedef_struct_lines.append(line)
-            last_typedef_struct_line = line
-            
-    if last_typedef_struct_line:
-        index = function_code.rfind(last_typedef_struct_line) + len(last_typedef_struct_line)
-        function_code = function_code[index:]
-    else:
-        last_include_line = None
-        for line in lines:
-            if line.startswith("#include"):
-                last_include_line = line
-    
-        if last_include_line:
-            index = function_code.rfind(last_include_line) + len(last_include_line)
-            function_code = function_code[index:]
-
-    ## Skip the includes and the structs (typedef struct) in wrapper code
-    last_typedef_struct_line = None
-    lines = wrapper_code.split("\n")
-    wrapper_code_typedef_struct_lines = []
-    for line in lines:
-        if line.startswith("typedef"):
-            wrapper_code_typedef_struct_lines.append(line)
-            last_typedef_struct_line = line
-    if last_typedef_struct_line:
-        index = wrapper_code.rfind(last_typedef_struct_line) + len(last_typedef_struct_line)
-    else:
-        last_include_line = None
-        for line in lines:
-            if line.startswith("#include"):
-                last_include_line = line
-    
-        if last_include_line:
-            index = wrapper_code.rfind(last_include_line) + len(last_include_line)
-            
-    new_typedef_struct_lines_to_insert = []
-    for line in function_code_typedef_struct_lines:
-        if line not in wrapper_code_typedef_struct_lines:
-            new_typedef_struct_lines_to_insert.append(line)
-    
-    new_wrapper_code = wrapper_code[:index] + '\n'.join(new_typedef_struct_lines_to_insert) + '\n\n' + function_code + wrapper_code[index:]
-
-    return new_wrapper_code    
-            
+    """
+    Inserts the functions of function_code after the typedefs of the
+    wrapper code, along with the typedefs the wrapper does not have. The
+    wrapper's own definitions of those functions are removed.
+    """
+    wrapper = index_c(wrapper_code)
+    function = index_c(function_code)
+
+    edits = [wrapper.extent(d) + ('',) for d in wrapper.functions.values() if d.name in function.functions]
+
+    wrapper_typedefs = {wrapper_code[d.start:d.end] for d in wrapper.header() if d.kind == 'typedef'}
+    new_typedefs = []
+    for d in function.header():
+        typedef = function_code[d.start:d.end]
+        if d.kind == 'typedef' and typedef not in wrapper_typedefs and typedef not in new_typedefs:
+            new_typedefs.append(typedef)
+
+    index = wrapper.header_end()
+    edits.append((index, index, '\n' + '\n'.join(new_typedefs) + '\n\n' + function_body(function)))
+    return splice(wrapper_code, edits)
+
+@traced("compose.dependencies")
+def compose_dependencies(wrapper_code, dependencies):
+    """
+    Replaces the prototypes of the dependencies in the wrapper code with
+    their implementations, given as (function_code, function_declare)
+    pairs, in one pass over the wrapper. Every function ends up defined
+    once, where it is first defined in program order: an implementation
+    leaves out the helpers defined before its prototype, and the wrapper's
+    later definitions of its functions are removed.
+    """
+    wrapper = index_c(wrapper_code)
+    targets = dict()
+    missing = []
+    for (function_code, function_declare) in dependencies:
+        name = index_c(function_declare).declarations[0].name
+        targets.setdefault(name, []).append(index_c(function_code))
+
+    positions = dict()
+    for declaration in wrapper.declarations:
+        if declaration.kind in ('prototype', 'function') and declaration.name in targets:
+            positions.setdefault(declaration.name, declaration)
+    for name in targets:
+        if name not in positions:
+            # the prototype was left out of the completion, so define the
+            # function ahead of everything that may call it.
+            missing.extend(targets[name])
+
+    defined = set()
+    edits = []
+
+    def implement(start, end, functions):
+        bodies = []
+        for function in functions:
+            bodies.append(function_body(function, skip=defined).strip('\n'))
+            defined.update(function.functions)
+        edits.append((start, end, '\n' + '\n\n'.join(bodies) + '\n\n'))
+
+    if missing:
+        position = wrapper.header_end()
+        implement(position, position, missing)
+    for declaration in wrapper.declarations:
+        if positions.get(declaration.name) is declaration:
+            implement(*wrapper.extent(declaration), targets[declaration.name])
+        elif declaration.kind == 'function':
+            if declaration.name in defined:
+                edits.append(wrapper.extent(declaration) + ('',))
+            defined.add(declaration.name)
+    return splice(wrapper_code, edits)
+
 def replace_wrapper_code(wrapper_code, function_code, function_declare):
-    function_declare = function_declare[:-3]
-    wrapper_code_lines = wrapper_code.split('\n')
-    start_idx = 0
-    flag = 0
-    for i in range(len(wrapper_code_lines)):
-        if wrapper_code_lines[i].startswith(function_declare):
-            start_idx = i
-            if wrapper_code_lines[i].endswith(";"):
-                flag = 1
-                end_idx = i + 1
-            break
-    
-    if not flag:
-        for i in range(start_idx, len(wrapper_code_lines)):
-            if wrapper_code_lines[i].startswith('}'):
-                end_idx = i + 1
-                break
-    
-    # print("Start idx:", start_idx)
-    # print("End idx:", end_idx)
-    wrapper_code_function_definitions_beg = find_all_function_definitions('\n'.join(wrapper_code_lines[:start_idx]))
-    function_code_function_definitions = find_all_function_definitions(function_code)
-    
-    # print(wrapper_code_function_definitions_beg)
-    # print(function_code_function_definitions)
-    removals = []
-    for func in function_code_function_definitions:
-        if func in wrapper_code_function_definitions_beg:
-            removals.append(function_code_function_definitions[func])
-    removals.sort()
-    function_code = remove_function_definition(function_code, removals)
-    wrapper_code_lines = wrapper_code.split('\n')
-    start_idx = 0
-    flag = 0
-    for i in range(len(wrapper_code_lines)):
-        if wrapper_code_lines[i].startswith(function_declare):
-            start_idx = i
-            if wrapper_code_lines[i].endswith(";"):
-                flag = 1
-                end_idx = i + 1
-            break
-    
-    if not flag:
-        for i in range(start_idx, len(wrapper_code_lines)):
-            if wrapper_code_lines[i].startswith('}'):
-                end_idx = i + 1
-                break
-    
-    wrapper_code_function_definitions_end = find_all_function_definitions('\n'.join(wrapper_code_lines[end_idx:]))
-    function_code_function_definitions = find_all_function_definitions(function_code)
-    removals = []
-    for func in wrapper_code_function_definitions_end:
-        if func in function_code_function_definitions:
-            removals.append(wrapper_code_function_definitions_end[func])
-            
-    removals.sort()
-    # print("Wrapper code removals:", removals)
-    wrapper_code = remove_function_definition(wrapper_code, removals)
-    
-    # print("Wrapper code after removals:", wrapper_code)
-    
-    wrapper_code_lines = wrapper_code.split('\n')
-    
-    # find the start of function body in function code
-    last_typedef_struct_line = None
-    lines = function_code.split("\n")
-    for line in lines:
-        if line.startswith("typedef"):
-            last_typedef_struct_line = line
-    if last_typedef_struct_line:
-        index = function_code.rfind(last_typedef_struct_line) + len(last_typedef_struct_line)
-        function_code = function_code[index:]
-    else:
-        last_include_line = None
-        for line in lines:
-            if line.startswith("#include"):
-                last_include_line = line
-    
-        if last_include_line:
-            index = function_code.rfind(last_include_line) + len(last_include_line)
-            function_code = function_code[index:]
-    
-    # Replace the function signature with the function code
-    new_wrapper_code = '\n'.join(wrapper_code_lines[:start_idx]) + '\n' + function_code + '\n' + '\n'.join(wrapper_code_lines[end_idx:])
-    
-    return new_wrapper_code
+    """
+    Replaces the prototype function_declare in the wrapper code with the
+    implementation in function_code.
+    """
+    return compose_dependencies(wrapper_code, [(function_code, function_declare)])
 
+@traced("compose.insert_regex_impl")
 def insert_regex_impl(wrapper_code, regex_impl):
     """
     Inserts the regex implementation code after the last typedef struct or #include,
     but before any function definitions.
     """
-    lines = wrapper_code.split("\n")
-    
-    # Find the insertion point - after the last typedef or include
-    last_typedef_or_include_idx = -1
-    for i, line in enumerate(lines):
-        if line.startswith("typedef") or line.startswith("#include"):
-            last_typedef_or_include_idx = i
-    
-    # If we found a typedef or include, insert after it
-    if last_typedef_or_include_idx >= 0:
-        insertion_point = last_typedef_or_include_idx + 1
-        new_code = '\n'.join(lines[:insertion_point]) + '\n' + regex_impl + '\n' + '\n'.join(lines[insertion_point:])
-    else:
-        # Otherwise, just prepend it
-        new_code = regex_impl + '\n' + wrapper_code
-    
-    return new_code
-
-def run_wrapper_model(model, function_prototypes=None, filter_functions=None, partial=True, temperature=0.6):
-    """
-    Run a model and print the results.
-    """
-    oracle = oracles.KleeOracle(model, function_prototypes, temperature=temperature)
-    if partial:
-        if type(model).__name__ == 'RegexModule':
-            oracle.build_eywa_regex_model()
+    header = [d for d in index_c(wrapper_code).header()
+              if d.kind == 'typedef' or (d.kind == 'directive' and d.name == 'include')]
+    if not header:
+        return regex_impl + '\n' + wrapper_code
+    index = header[-1].end
+    return wrapper_code[:index] + '\n' + regex_impl + '\n' + wrapper_code[index:]
+
+def run_wrapper_model(model, function_prototypes=None, filter_functions=None, partial=True, temperature=0.6, slot=0, regex_backend='dfa', store=None, completion=None):
+    """
+    Run a model and print the results. With an ImplementationStore, the
+    LLM is only queried if the store has no implementation for the model's
+    fingerprint. A given completion is used as the implementation as is.
+    """
+    oracle = oracles.KleeOracle(model, function_prototypes, temperature=temperature, slot=slot, regex_backend=regex_backend)
+    oracle.completion = completion
+    fingerprint = None
+    if completion is None and store is not None and type(model).__name__ != 'RegexModule':
+        fingerprint = oracle.fingerprint()
+        oracle.completion = store.lookup(fingerprint)
+    oracle.reused = oracle.completion is not None
+    with span("synthesize.node", node=model.name, partial=partial, reused=oracle.reused):
+        if partial:
+            if type(model).__name__ == 'RegexModule':
+                oracle.build_eywa_regex_model()
+            else:
+                oracle.build_compositional_model()
         else:
-            oracle.build_compositional_model()
-    else:
-        oracle.build_filter_and_test_model(filter_functions)
-        
-    return oracle
\ No newline at end of file
+            oracle.build_filter_and_test_model(filter_functions)
+    if fingerprint is not None and not oracle.reused:
+        store.store(fingerprint, oracle.completion)
+
+    return oracle
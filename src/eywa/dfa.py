@@ -0,0 +1,190 @@
+from typing import Dict, List, Tuple
+
+import eywa.regex as re
+
+
+class NFA:
+    """
+    A Thompson NFA for an Eywa regex, with epsilon edges and edges labeled
+    by inclusive character ranges.
+    """
+
+    def __init__(self):
+        self.epsilon = []
+        self.edges = []
+        self.ranges = []
+
+    def state(self) -> int:
+        self.epsilon.append([])
+        self.edges.append([])
+        return len(self.epsilon) - 1
+
+    def build(self, r: re.Regex) -> Tuple[int, int]:
+        """
+        Adds the states for a regex and returns its (start, end) states.
+        """
+        start = self.state()
+        end = self.state()
+        if isinstance(r, re.Empty):
+            self.epsilon[start].append(end)
+        elif isinstance(r, re.Range):
+            self.ranges.append((ord(r.low), ord(r.high)))
+            self.edges[start].append((len(self.ranges) - 1, end))
+        elif isinstance(r, re.Choice):
+            for expr in r.exprs:
+                (s, e) = self.build(expr)
+                self.epsilon[start].append(s)
+                self.epsilon[e].append(end)
+        elif isinstance(r, re.Seq):
+            current = start
+            for expr in r.exprs:
+                (s, e) = self.build(expr)
+                self.epsilon[current].append(s)
+                current = e
+            self.epsilon[current].append(end)
+        elif isinstance(r, re.Star):
+            (s, e) = self.build(r.expr)
+            self.epsilon[start].append(s)
+            self.epsilon[start].append(end)
+            self.epsilon[e].append(s)
+            self.epsilon[e].append(end)
+        else:
+            raise Exception(f'Unknown regex: {r}')
+        return (start, end)
+
+    def closure(self, states) -> frozenset:
+        stack = list(states)
+        seen = set(stack)
+        while stack:
+            for t in self.epsilon[stack.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return frozenset(seen)
+
+
+class DFA:
+    """
+    A minimized DFA over byte classes. Characters that belong to exactly
+    the same ranges of the regex share a class, so the transition table has
+    one column per class rather than one per byte. State 0 is the start
+    state and every table is total: a rejected prefix moves to a dead state.
+    """
+
+    def __init__(self, classes: List[int], delta: List[List[int]], accept: List[bool]):
+        self.classes = classes
+        self.delta = delta
+        self.accept = accept
+
+    @staticmethod
+    def from_regex(r: re.Regex):
+        """
+        Builds the minimized DFA for a regex by subset construction over
+        its Thompson NFA followed by partition refinement.
+        """
+        nfa = NFA()
+        (start, end) = nfa.build(r)
+
+        # group the bytes by the set of ranges that contain them.
+        signatures = {}
+        classes = []
+        for c in range(256):
+            signature = tuple(i for (i, (low, high)) in enumerate(nfa.ranges) if low <= c <= high)
+            classes.append(signatures.setdefault(signature, len(signatures)))
+        members = [None] * len(signatures)
+        for (signature, cls) in signatures.items():
+            members[cls] = set(signature)
+
+        # subset construction.
+        initial = nfa.closure([start])
+        subsets = {initial: 0}
+        worklist = [initial]
+        delta = []
+        accept = []
+        while worklist:
+            subset = worklist.pop(0)
+            row = []
+            for cls in range(len(members)):
+                targets = [t for s in subset for (i, t) in nfa.edges[s] if i in members[cls]]
+                target = nfa.closure(targets)
+                if target not in subsets:
+                    subsets[target] = len(subsets)
+                    worklist.append(target)
+                row.append(subsets[target])
+            delta.append(row)
+            accept.append(end in subset)
+        return DFA(classes, delta, accept).minimize()
+
+    def minimize(self):
+        """
+        Merges equivalent states with Moore's partition refinement and
+        renumbers the states in breadth-first order from the start state.
+        """
+        block = [1 if a else 0 for a in self.accept]
+        while True:
+            signatures = {}
+            refined = [signatures.setdefault((block[s], tuple(block[t] for t in row)), len(signatures))
+                       for (s, row) in enumerate(self.delta)]
+            if len(signatures) == len(set(block)):
+                break
+            block = refined
+        order = {block[0]: 0}
+        queue = [0]
+        representative = {block[0]: 0}
+        while queue:
+            s = queue.pop(0)
+            for t in self.delta[s]:
+                if block[t] not in order:
+                    order[block[t]] = len(order)
+                    representative[block[t]] = t
+                    queue.append(t)
+        states = sorted(order, key=order.get)
+        delta = [[order[block[t]] for t in self.delta[representative[b]]] for b in states]
+        accept = [self.accept[representative[b]] for b in states]
+        return DFA(self.classes, delta, accept)
+
+    def matches(self, s: str) -> bool:
+        """
+        Runs the DFA on a string, like the generated C matcher does.
+        """
+        state = 0
+        for c in s:
+            c = ord(c)
+            if c > 255:
+                return False
+            state = self.delta[state][self.classes[c]]
+        return self.accept[state]
+
+    def c_tables(self, name: str) -> List[str]:
+        """
+        Returns C declarations of the class map, transition and accepting
+        state tables for this DFA, prefixed with the given name.
+        """
+        num_classes = len(self.delta[0])
+        delta = ', '.join('{' + ', '.join(map(str, row)) + '}' for row in self.delta)
+        return [
+            f'static const unsigned char {name}_classes[256] = {{{", ".join(map(str, self.classes))}}};',
+            f'static const unsigned short {name}_delta[{len(self.delta)}][{num_classes}] = {{{delta}}};',
+            f'static const unsigned char {name}_accept[{len(self.accept)}] = {{{", ".join(str(int(a)) for a in self.accept)}}};',
+        ]
+
+    def c_match(self, name: str, text: str) -> str:
+        """
+        Returns a C expression that matches text against the tables
+        declared by c_tables(name).
+        """
+        return f'dfa_match({name}_classes, &{name}_delta[0][0], {len(self.delta[0])}, {name}_accept, {text})'
+
+
+_dfas: Dict[str, DFA] = {}
+
+
+def compile_regex(r: re.Regex) -> DFA:
+    """
+    Returns the minimized DFA for a regex, shared between regexes with the
+    same structure.
+    """
+    pattern = r.pattern()
+    if pattern not in _dfas:
+        _dfas[pattern] = DFA.from_regex(r)
+    return _dfas[pattern]
@@ -0,0 +1,637 @@
+import io
+import itertools
+import os
+import queue
+import tarfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Union
+
+import docker
+from docker.types import Ulimit
+
+from eywa.cache import DiskCache, content_key, default_cache_dir
+from eywa.ktest import KTest, iter_ktest_archive
+from eywa.trace import in_context, record, span
+
+KLEE_REPOSITORY = "klee/klee"
+KLEE_TAG = "3.0"
+PROGRAMS_DIR = "/home/klee/programs"
+CLANG_FLAGS = "-emit-llvm -g -c"
+
+class KleeOptions:
+    """
+    The search heuristics and resource limits of a KLEE run. Every option
+    left as None (or False) keeps KLEE's default, so KleeOptions() runs the
+    same command as before options existed.
+
+    search: the --search heuristics, interleaved by KLEE if several.
+    max_memory_mb: --max-memory, the memory cap in MB.
+    max_solver_time_sec: --max-solver-time, the limit per solver query.
+    only_covering_new: --only-output-states-covering-new, so that only
+        tests that cover new code are written.
+    batch_instructions, batch_time_sec: --use-batching-search with
+        --batch-instructions and --batch-time, which keeps the searcher on a
+        state for that many instructions or seconds.
+    rng_seed: --rng-initial-seed, to make randomized searches repeatable.
+    seeds: the contents of .ktest files that KLEE replays first
+        (--seed-dir), allowing for seeds with more or fewer objects. They are
+        attached to a copy of the options with with_seeds.
+    """
+
+    def __init__(self, search: Union[List[str], None] = None, max_memory_mb: Union[int, None] = None,
+                 max_solver_time_sec: Union[int, None] = None, only_covering_new: bool = False,
+                 batch_instructions: Union[int, None] = None, batch_time_sec: Union[int, None] = None,
+                 rng_seed: Union[int, None] = None):
+        self.search = search
+        self.max_memory_mb = max_memory_mb
+        self.max_solver_time_sec = max_solver_time_sec
+        self.only_covering_new = only_covering_new
+        self.batch_instructions = batch_instructions
+        self.batch_time_sec = batch_time_sec
+        self.rng_seed = rng_seed
+        self.seeds = None
+
+    def with_seeds(self, seeds: List[bytes]):
+        """
+        Returns a copy of the options that seeds KLEE with the given tests.
+        """
+        options = KleeOptions()
+        options.__dict__.update(self.__dict__)
+        options.seeds = list(seeds)
+        return options
+
+    @staticmethod
+    def preset(name: str):
+        """
+        Returns the options of a preset:
+
+        default: KLEE's defaults.
+        throughput: the most unique tests per minute. Depth-first search
+            finishes paths (and so writes tests) quickly with little
+            memory, and a short solver timeout skips paths that are
+            expensive to solve instead of stalling on them.
+        coverage: the most code covered. KLEE's random-path and
+            coverage-guided searchers in batches, writing only the tests
+            that cover new code.
+        """
+        if name not in KLEE_PRESETS:
+            raise Exception(f'Unknown KLEE preset: {name}')
+        return KleeOptions(**KLEE_PRESETS[name])
+
+    def flags(self) -> List[str]:
+        """
+        Returns the KLEE command line flags for the options.
+        """
+        flags = []
+        for heuristic in self.search or []:
+            flags.append(f"--search={heuristic}")
+        if self.batch_instructions is not None or self.batch_time_sec is not None:
+            flags.append("--use-batching-search")
+            if self.batch_instructions is not None:
+                flags.append(f"--batch-instructions={self.batch_instructions}")
+            if self.batch_time_sec is not None:
+                flags.append(f"--batch-time={self.batch_time_sec}s")
+        if self.max_memory_mb is not None:
+            flags.append(f"--max-memory={self.max_memory_mb}")
+        if self.max_solver_time_sec is not None:
+            flags.append(f"--max-solver-time={self.max_solver_time_sec}s")
+        if self.only_covering_new:
+            flags.append("--only-output-states-covering-new")
+        if self.rng_seed is not None:
+            flags.append(f"--rng-initial-seed={self.rng_seed}")
+        if self.seeds:
+            flags.extend(["--seed-dir=seeds", "--allow-seed-extension", "--allow-seed-truncation"])
+        return flags
+
+    def to_dict(self) -> dict:
+        options = dict(self.__dict__)
+        options["seeds"] = len(self.seeds or [])
+        return options
+
+
+KLEE_PRESETS = {
+    "default": {},
+    "throughput": {"search": ["dfs"], "max_memory_mb": 2000, "max_solver_time_sec": 2},
+    "coverage": {"search": ["random-path", "nurs:covnew"], "batch_instructions": 10000,
+                 "max_memory_mb": 4000, "max_solver_time_sec": 10, "only_covering_new": True},
+}
+
+
+def klee_command(timeout: int, options: Union[KleeOptions, None] = None) -> str:
+    """
+    Returns the KLEE command line used to explore test.bc.
+    """
+    flags = "" if options is None else "".join(f" {flag}" for flag in options.flags())
+    return f"klee --output-dir=klee-out --libc=uclibc --posix-runtime -max-time={timeout}s{flags} --external-calls=all test.bc"
+
+
+def _tar_files(files) -> bytes:
+    """
+    Builds an in-memory tar archive from a dict of file names to contents.
+    """
+    tar_stream = io.BytesIO()
+    with tarfile.open(fileobj=tar_stream, mode='w') as tar:
+        for (name, content) in files.items():
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = len(data)
+            tarinfo.mode = 0o644
+            tar.addfile(tarinfo, io.BytesIO(data))
+    return tar_stream.getvalue()
+
+
+def _read_archive_file(stream) -> bytes:
+    """
+    Reads the single file contained in a tar stream returned by get_archive.
+    """
+    file_like_object = io.BytesIO()
+    for chunk in stream:
+        file_like_object.write(chunk)
+    file_like_object.seek(0)
+    content = b''
+    with tarfile.open(fileobj=file_like_object, mode='r|') as tar:
+        for member in tar:
+            f = tar.extractfile(member)
+            if f is not None:
+                content = f.read()
+    return content
+
+
+class BitcodeCache(DiskCache):
+    """
+    A host-side cache of compiled test.bc files, and of the clang diagnostics
+    for programs that failed to compile, keyed by the SHA-256 of the program
+    text, the compiler flags and the KLEE image.
+    """
+
+    def __init__(self, directory: Union[str, None] = None, max_bytes: int = 1024 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), "bitcode")
+        super().__init__(directory, max_bytes=max_bytes)
+
+    @staticmethod
+    def program_key(program: str, image_name: str = f"{KLEE_REPOSITORY}:{KLEE_TAG}") -> str:
+        return content_key(program, CLANG_FLAGS, image_name)
+
+    def lookup(self, key: str):
+        """
+        Returns a (bitcode, diagnostics) pair, either of which may be None.
+        """
+        diagnostics = self.get(content_key(key, "diagnostics"))
+        if diagnostics is not None:
+            return None, diagnostics.decode("utf-8")
+        return self.get(key), None
+
+    def store_bitcode(self, key: str, bitcode: bytes) -> None:
+        self.put(key, bitcode)
+
+    def store_diagnostics(self, key: str, diagnostics: str) -> None:
+        self.put(content_key(key, "diagnostics"), diagnostics.encode("utf-8"))
+
+
+class KleeWorker:
+    """
+    A long-lived KLEE container. Every job runs in its own working
+    directory, so the container can be reused for any program.
+    """
+
+    def __init__(self, container, bitcode_cache: Union[BitcodeCache, None] = None):
+        self.container = container
+        self.bitcode_cache = bitcode_cache
+        self.index = None
+
+    def alive(self) -> bool:
+        """
+        Returns whether the container is still running.
+        """
+        try:
+            self.container.reload()
+            return self.container.status == "running"
+        except docker.errors.APIError:
+            return False
+
+    def _exec(self, command: str):
+        return self.container.exec_run(f"/bin/bash -c '{command}'")
+
+    def _compile(self, job_dir: str, program: str) -> None:
+        """
+        Places test.c and test.bc in the job directory, reusing a cached
+        bitcode file (or compile error) for the same program when possible.
+        """
+        key = None
+        if self.bitcode_cache is not None:
+            key = BitcodeCache.program_key(program)
+            (bitcode, diagnostics) = self.bitcode_cache.lookup(key)
+            if diagnostics is not None:
+                raise Exception(
+                    f'Unable to compile generated program with error\n{diagnostics}')
+            if bitcode is not None:
+                with span("klee.upload", bitcode_cached=True):
+                    self.container.put_archive(job_dir, _tar_files({"test.c": program, "test.bc": bitcode}))
+                return
+        with span("klee.upload", bitcode_cached=False):
+            self.container.put_archive(job_dir, _tar_files({"test.c": program}))
+
+        # run the clang command
+        with span("klee.clang"):
+            _, output = self._exec(
+                f"cd {job_dir} && clang {CLANG_FLAGS} test.c -o test.bc")
+        clang_output = output.decode('utf-8')
+        if "error" in clang_output or "Error" in clang_output:
+            if key is not None:
+                self.bitcode_cache.store_diagnostics(key, clang_output)
+            raise Exception(
+                f'Unable to compile generated program with error\n{clang_output}')
+        if key is not None:
+            stream, _ = self.container.get_archive(f"{job_dir}/test.bc")
+            self.bitcode_cache.store_bitcode(key, _read_archive_file(stream))
+
+    def _fetch_tests(self, job_dir: str, first: int, last: int) -> Iterator[KTest]:
+        """
+        Downloads and decodes the tests numbered first to last (inclusive).
+        """
+        if last < first:
+            return
+        with span("klee.extract", first=first, last=last) as extract_span:
+            result = self.container.exec_run(
+                f"/bin/bash -c 'cd {job_dir}/klee-out && seq -f \"test%06.0f.ktest\" {first} {last} | tar -cf - -T - 2>/dev/null'",
+                demux=True)
+            (stdout, _) = result.output
+            tests = list(iter_ktest_archive([stdout])) if stdout else []
+            extract_span.set(bytes=len(stdout or b''), tests=len(tests))
+        if tests:
+            tests[-1].poll_end = True
+        yield from tests
+
+    def _last_test(self, job_dir: str) -> int:
+        """
+        Returns the number of the newest .ktest file KLEE has started writing.
+        """
+        _, output = self._exec(
+            f"ls {job_dir}/klee-out 2>/dev/null | grep \"^test[0-9]*\\.ktest$\" | tail -1")
+        name = output.decode("utf-8").strip()
+        return int(name[4:-6]) if name else 0
+
+    def stream(self, program: str, timeout: int, options: Union[KleeOptions, None] = None, poll_sec: float = 2.0,
+               interrupt: Union[Callable[[float], bool], None] = None) -> Iterator[KTest]:
+        """
+        Compiles and runs KLEE on the program and yields the decoded .ktest
+        records while KLEE is still running. KLEE numbers its tests
+        consecutively, so every test older than the newest one is complete
+        and is fetched on the next poll; the last test of a poll is marked
+        with poll_end. If the consumer stops early, or interrupt (called at
+        every poll with the time KLEE started) returns True, the KLEE
+        process is interrupted.
+        """
+        job_dir = f"{PROGRAMS_DIR}/job_{uuid.uuid4().hex}"
+        result = self._exec(f"mkdir -p {job_dir}")
+        if result.exit_code != 0:
+            raise Exception(
+                f'Failed to create job directory inside container:\n{result.output.decode()}')
+        api = self.container.client.api
+        exec_id = None
+        running = False
+        job_start = time.time()
+        klee_start = None
+        tests = 0
+        try:
+            self._compile(job_dir, program)
+            if options is not None and options.seeds:
+                self._exec(f"mkdir -p {job_dir}/seeds")
+                self.container.put_archive(f"{job_dir}/seeds", _tar_files(
+                    {f"seed{i:06d}.ktest": seed for (i, seed) in enumerate(options.seeds)}))
+
+            # run the klee command in the background
+            exec_id = api.exec_create(
+                self.container.id,
+                f"/bin/bash -c 'cd {job_dir} && echo $$ > klee.pid && exec {klee_command(timeout, options)} > klee.log 2>&1'")["Id"]
+            api.exec_start(exec_id, detach=True)
+            klee_start = time.time()
+            running = True
+            fetched = 0
+            while running:
+                time.sleep(poll_sec)
+                if interrupt is not None and interrupt(klee_start):
+                    return
+                running = api.exec_inspect(exec_id)["Running"]
+                last = self._last_test(job_dir)
+                ready = last if not running else last - 1
+                for test in self._fetch_tests(job_dir, fetched + 1, ready):
+                    tests += 1
+                    yield test
+                fetched = max(fetched, ready)
+
+            _, output = self._exec(f"cat {job_dir}/klee.log")
+            klee_output = output.decode('utf-8')
+            if 'KLEE: done:' not in klee_output:
+                raise Exception(f'KLEE execution failed with error\n{klee_output}')
+        finally:
+            if running:
+                self._exec(f"kill -INT $(cat {job_dir}/klee.pid) 2>/dev/null; while kill -0 $(cat {job_dir}/klee.pid) 2>/dev/null; do sleep 0.1; done")
+            if klee_start is not None:
+                record("klee.run", klee_start, time.time(), timeout=timeout, tests=tests, interrupted=running)
+            self._exec(f"rm -rf {job_dir}")
+            record("klee.job", job_start, time.time(), container=self.container.name, tests=tests)
+
+    def run(self, program: str, timeout: int, options: Union[KleeOptions, None] = None) -> List[KTest]:
+        """
+        Compiles and runs KLEE on the program and returns the decoded
+        .ktest records for all of the generated tests.
+        """
+        return list(self.stream(program, timeout, options))
+
+
+class KleeRuntime:
+    """
+    Process-wide KLEE runtime state: a single connection-pooled Docker
+    client and the resolved KLEE image. Both are initialised lazily on
+    first use and then shared by every pool and oracle in the process.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, repository: str = KLEE_REPOSITORY, tag: str = KLEE_TAG, max_pool_size: int = 16):
+        self.repository = repository
+        self.tag = tag
+        self.image_name = f"{repository}:{tag}"
+        self.max_pool_size = max_pool_size
+        self.setup_time = 0.0
+        self.reuses = 0
+        self._client = None
+        self._image = None
+        self._setup_lock = threading.Lock()
+
+    @staticmethod
+    def get():
+        """
+        Returns the process-wide runtime, creating it on first use.
+        """
+        with KleeRuntime._lock:
+            if KleeRuntime._instance is None:
+                KleeRuntime._instance = KleeRuntime()
+            return KleeRuntime._instance
+
+    @staticmethod
+    def current():
+        """
+        Returns the process-wide runtime if it has been created, else None.
+        """
+        return KleeRuntime._instance
+
+    def setup(self):
+        """
+        Returns the shared Docker client and KLEE image, connecting to Docker
+        and resolving (or pulling) the image only the first time.
+        """
+        with self._setup_lock:
+            if self._image is not None:
+                return self._client, self._image
+            start_time = time.time()
+            with span("klee.runtime_setup", image=self.image_name):
+                if self._client is None:
+                    self._client = docker.from_env(max_pool_size=self.max_pool_size)
+                try:
+                    self._image = self._client.images.get(self.image_name)
+                except docker.errors.ImageNotFound:
+                    print(f"Pulling docker image {self.image_name}...")
+                    # Will raise an exception if the image cannot be pulled
+                    self._image = self._client.images.pull(self.repository, tag=self.tag)
+                    print(f"Successfully pulled {self.image_name}")
+            self.setup_time = time.time() - start_time
+            return self._client, self._image
+
+    def acquire(self):
+        """
+        Like setup(), but records a reuse when the setup was already done,
+        which is the cost each KLEE job used to pay on its own.
+        """
+        if self._image is not None:
+            with self._setup_lock:
+                self.reuses += 1
+        return self.setup()
+
+    def stats(self):
+        """
+        Returns how much time was spent on setup and how many times the
+        cached setup was reused, since the runtime was created.
+        """
+        return {
+            "Setup_Time": self.setup_time,
+            "Setup_Reuses": self.reuses,
+        }
+
+
+class KleePool:
+    """
+    A pool of warm KLEE containers that share the runtime's Docker client.
+    Containers are created on first use, up to size, and are kept running
+    between jobs. Jobs can be run synchronously with run() or in the
+    background with submit().
+    """
+
+    _shared = None
+    _shared_size = 1
+    _shared_lock = threading.Lock()
+
+    def __init__(self, size: int = 1, runtime: KleeRuntime = None, name_prefix: str = "eywa_klee_worker", bitcode_cache: Union[BitcodeCache, None] = None):
+        self.size = size
+        self.runtime = runtime if runtime is not None else KleeRuntime.get()
+        self.bitcode_cache = bitcode_cache if bitcode_cache is not None else BitcodeCache()
+        self.name_prefix = name_prefix
+        self._idle = deque()
+        # the indices (and so the names) of the containers started so far.
+        self._indices = set()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+    @staticmethod
+    def configure(size: int) -> None:
+        """
+        Sets the number of containers used by the process-wide pool. The pool
+        itself (and its Docker client) is only created on first use.
+        """
+        with KleePool._shared_lock:
+            KleePool._shared_size = size
+            if KleePool._shared is not None and size > KleePool._shared.size:
+                KleePool._shared.resize(size)
+
+    @staticmethod
+    def shared():
+        """
+        Returns the process-wide pool, creating it on first use.
+        """
+        with KleePool._shared_lock:
+            if KleePool._shared is None:
+                KleePool._shared = KleePool(size=KleePool._shared_size)
+            return KleePool._shared
+
+    @staticmethod
+    def set_shared(pool) -> None:
+        """
+        Replaces the process-wide pool, e.g. with one that replays
+        previously captured tests.
+        """
+        with KleePool._shared_lock:
+            KleePool._shared = pool
+
+    def resize(self, size: int) -> None:
+        """
+        Changes the maximum number of containers in the pool.
+        """
+        with self._available:
+            self.size = size
+            old = self._executor
+            self._executor = ThreadPoolExecutor(max_workers=size)
+            self._available.notify_all()
+        old.shutdown(wait=False)
+
+    def _start_worker(self, index: int) -> KleeWorker:
+        client, _ = self.runtime.setup()
+        container_name = f"{self.name_prefix}_{index}"
+        with span("klee.container_setup", container=container_name):
+            return self._start_container(client, container_name)
+
+    def _start_container(self, client, container_name: str) -> KleeWorker:
+        try:
+            container = client.containers.get(container_name)
+        except docker.errors.NotFound:
+            container = client.containers.create(
+                self.runtime.image_name,
+                name=container_name,
+                command="/bin/sh -c 'tail -f /dev/null'",  # keep the container running
+                detach=True,
+                ulimits=[Ulimit(name='stack', soft=-1, hard=-1)]
+            )
+            print(f"Created new container {container_name}.")
+        if container.status != "running":
+            container.start()
+        result = container.exec_run(f"mkdir -p {PROGRAMS_DIR}")
+        if result.exit_code != 0:
+            raise Exception(
+                f'Failed to create directory inside container:\n{result.output.decode()}')
+        return KleeWorker(container, self.bitcode_cache)
+
+    @contextmanager
+    def worker(self):
+        """
+        Checks out a worker for the duration of the context, starting a new
+        container if none is idle and the pool is not yet full, and otherwise
+        waiting until a worker is returned or a container slot frees up. A
+        worker whose container died during the job is dropped instead of
+        being returned to the pool.
+        """
+        worker = None
+        with self._available:
+            while True:
+                if self._idle:
+                    worker = self._idle.popleft()
+                    break
+                if len(self._indices) < self.size:
+                    index = next(i for i in itertools.count() if i not in self._indices)
+                    self._indices.add(index)
+                    break
+                self._available.wait()
+        if worker is None:
+            try:
+                worker = self._start_worker(index)
+            except BaseException:
+                with self._available:
+                    self._indices.discard(index)
+                    self._available.notify()
+                raise
+            worker.index = index
+        healthy = True
+        try:
+            yield worker
+        except Exception:
+            healthy = worker.alive()
+            raise
+        finally:
+            with self._available:
+                if healthy:
+                    self._idle.append(worker)
+                else:
+                    print(f"Dropped KLEE container {worker.container.name}, which is no longer running.")
+                    self._indices.discard(worker.index)
+                self._available.notify()
+
+    def stream(self, program: str, timeout: int, options: Union[KleeOptions, None] = None,
+               interrupt: Union[Callable[[float], bool], None] = None) -> Iterator[KTest]:
+        """
+        Runs KLEE on the program and yields .ktest records as they are
+        written, until KLEE finishes or interrupt returns True. The worker
+        is held until the generator is exhausted or closed.
+        """
+        self.runtime.acquire()
+        with self.worker() as worker:
+            yield from worker.stream(program, timeout, options, interrupt=interrupt)
+
+    def run(self, program: str, timeout: int, options: Union[KleeOptions, None] = None) -> List[KTest]:
+        """
+        Runs KLEE on the program in the calling thread.
+        """
+        return list(self.stream(program, timeout, options))
+
+    def submit(self, program: str, timeout: int, options: Union[KleeOptions, None] = None) -> Future:
+        """
+        Schedules a KLEE run on the pool and returns a future for its .ktest records.
+        """
+        return self._executor.submit(self.run, program, timeout, options)
+
+    def shutdown(self, remove: bool = False) -> None:
+        """
+        Stops accepting jobs and optionally removes the pool's containers.
+        """
+        self._executor.shutdown(wait=True)
+        while self._idle:
+            worker = self._idle.popleft()
+            if remove:
+                worker.container.remove(force=True)
+
+
+def stream_all(pool, programs: List[str], timeout: int, options: Union[KleeOptions, None] = None,
+               interrupt: Union[Callable[[float], bool], None] = None) -> Iterator[KTest]:
+    """
+    Runs KLEE on several programs concurrently, each as its own job on the
+    pool, and yields their .ktest records in the order they arrive. Closing
+    the generator stops every job at its next test (or when it times out),
+    and every job is interrupted once interrupt returns True.
+    """
+    results = queue.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def run(program):
+        stream = pool.stream(program, timeout, options, interrupt=interrupt)
+        try:
+            for test in stream:
+                results.put(test)
+                if stop.is_set():
+                    break
+        except BaseException as e:
+            results.put(e)
+        finally:
+            stream.close()
+            results.put(done)
+
+    for program in programs:
+        threading.Thread(target=in_context(run), args=(program,), daemon=True).start()
+    remaining = len(programs)
+    try:
+        while remaining > 0:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
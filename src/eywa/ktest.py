@@ -0,0 +1,118 @@
+import io
+import struct
+import tarfile
+from typing import Iterable, Iterator, List, Tuple
+
+
+class KTest:
+    """
+    The contents of a KLEE .ktest file: the command line arguments and the
+    list of symbolic objects as (name, bytes) pairs in creation order.
+    """
+
+    def __init__(self, args: List[bytes], objects: List[Tuple[str, bytes]], name: str = None):
+        self.args = args
+        self.objects = objects
+        self.name = name
+        # set on the last test fetched by a KLEE poll, so that consumers
+        # that buffer tests know when to flush them.
+        self.poll_end = False
+
+    def values(self):
+        """
+        Returns a dict from object name to its bytes.
+        """
+        return dict(self.objects)
+
+
+def read_ktest(data: bytes, name: str = None) -> KTest:
+    """
+    Parses the binary .ktest format: a 5 byte magic ("KTEST" or "BOUT\\n"),
+    a version, the arguments, (for version >= 2) the symbolic argv sizes,
+    and finally the objects, each a length-prefixed name and byte buffer.
+    All integers are 32-bit big-endian.
+    """
+    if data[:5] not in (b"KTEST", b"BOUT\n"):
+        raise Exception(f'Invalid ktest file: {name}')
+    offset = 5
+
+    def u32():
+        nonlocal offset
+        (value,) = struct.unpack_from(">I", data, offset)
+        offset += 4
+        return value
+
+    def blob():
+        nonlocal offset
+        size = u32()
+        value = data[offset:offset + size]
+        if len(value) != size:
+            raise Exception(f'Truncated ktest file: {name}')
+        offset += size
+        return value
+
+    version = u32()
+    args = [blob() for _ in range(u32())]
+    if version >= 2:
+        offset += 8  # symArgvs, symArgvLen
+    objects = []
+    for _ in range(u32()):
+        object_name = blob().decode("utf-8", errors="replace")
+        objects.append((object_name, blob()))
+    return KTest(args, objects, name)
+
+
+def write_ktest(ktest: KTest) -> bytes:
+    """
+    Serializes a KTest in the version 3 .ktest format read by read_ktest.
+    """
+    def blob(value: bytes) -> bytes:
+        return struct.pack(">I", len(value)) + value
+
+    parts = [b"KTEST", struct.pack(">I", 3), struct.pack(">I", len(ktest.args))]
+    parts.extend(blob(arg) for arg in ktest.args)
+    parts.append(struct.pack(">II", 0, 0))
+    parts.append(struct.pack(">I", len(ktest.objects)))
+    for (name, data) in ktest.objects:
+        parts.append(blob(name.encode("utf-8")))
+        parts.append(blob(data))
+    return b"".join(parts)
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    A read-only file object over an iterator of byte chunks, so that a tar
+    archive from docker's get_archive can be decoded as it is downloaded.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def iter_ktest_archive(chunks: Iterable[bytes]) -> Iterator[KTest]:
+    """
+    Streams every .ktest file out of a tar archive given as byte chunks,
+    without extracting anything to disk.
+    """
+    stream = io.BufferedReader(_ChunkReader(chunks), buffer_size=1 << 16)
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(".ktest"):
+                continue
+            f = tar.extractfile(member)
+            yield read_ktest(f.read(), member.name.rsplit("/", 1)[-1])
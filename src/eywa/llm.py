@@ -1,42 +1,141 @@
 #!/usr/bin/env python3
 
+import json
+import os
 import sys
+from typing import List, Union
 
 import openai
 
 import eywa.key as key
+from eywa.cache import DiskCache, content_key, default_cache_dir
+from eywa.trace import span
+
+
+class CompletionCache(DiskCache):
+    """
+    A persistent cache of LLM completions keyed by the full request
+    (messages and sampling parameters) plus a sample slot, so that k
+    samples drawn at the same temperature remain distinct entries.
+    """
+
+    _shared = None
+    offline = False
+
+    def __init__(self, directory: Union[str, None] = None, max_bytes: int = 256 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), "completions")
+        super().__init__(directory, max_bytes=max_bytes)
+
+    @staticmethod
+    def shared():
+        """
+        Returns the process-wide completion cache, or None when caching has
+        been disabled by setting EYWA_LLM_CACHE=0.
+        """
+        if os.environ.get("EYWA_LLM_CACHE", "1").lower() in ("0", "off", "false"):
+            return None
+        if CompletionCache._shared is None:
+            CompletionCache._shared = CompletionCache()
+        return CompletionCache._shared
+
+    @staticmethod
+    def set_shared(cache) -> None:
+        """
+        Replaces the process-wide completion cache, e.g. with a recording.
+        """
+        CompletionCache._shared = cache
+
+    @staticmethod
+    def request_key(messages, params, slot: int = 0) -> str:
+        """
+        Returns the content address for a completion request.
+        """
+        return content_key(messages, params, slot)
+
+    def lookup(self, messages, params, slot: int = 0) -> Union[str, None]:
+        value = self.get(self.request_key(messages, params, slot))
+        return None if value is None else value.decode("utf-8")
+
+    def store(self, messages, params, slot: int, response_text: str) -> None:
+        self.put(self.request_key(messages, params, slot), response_text.encode("utf-8"))
+
+
+class CompletionRecording(CompletionCache):
+    """
+    Completions recorded in a JSONL file of {"key", "response"} lines, for
+    running the pipeline without the OpenAI API. A recording is offline:
+    a request that was not recorded is an error rather than an API call.
+    With record=True, requests go to the API and every completion is
+    appended to the file instead.
+    """
+
+    def __init__(self, path: str, record: bool = False):
+        self.path = path
+        self.offline = not record
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry["response"]
+
+    def get(self, key: str) -> Union[bytes, None]:
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.entries[key].encode("utf-8")
+
+    def put(self, key: str, value: bytes) -> None:
+        response = value.decode("utf-8")
+        self.entries[key] = response
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": key, "response": response}) + "\n")
 
 
 class GPT4:
-    def __init__(self):
+    def __init__(self, cache: Union[CompletionCache, None] = None):
         # openai.api_type = ''
         # openai.api_base = ''
         # openai.api_version = ''
-        openai.api_key = key.get_key()
+        self.cache = cache if cache is not None else CompletionCache.shared()
+        if self.cache is None or not self.cache.offline:
+            openai.api_key = key.get_key()
         # self.engine_ = ''
 
-    def query_openai_endpoint(self, user_prompt: str, temperature: float = 0.0, system_prompt: str = None) -> str:
+    def query_openai_endpoint(self, user_prompt: str, temperature: float = 0.0, system_prompt: str = None, slot: int = 0) -> str:
         '''
         Query the OpenAI endpoint and return the response.
 
         Args:
             user_prompt (str): The prompt to use.
             system_prompt (str): The system prompt to use.
+            slot (int): The sample index, so repeated samples at the same
+                temperature are cached separately.
         '''
 
-        messages = [{'role': 'user', 'content': user_prompt}]
-        if system_prompt is not None and system_prompt != "":
-            messages.append({'role': 'system', 'content': system_prompt})
+        (messages, params) = self._request(user_prompt, temperature, system_prompt)
 
-        response = openai.chat.completions.create(
-            # engine=self.engine_,
-            model='gpt-4',
-            messages=messages,
-            temperature=temperature,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None)
+        with span("llm.query", slot=slot, temperature=temperature, prompt_chars=len(user_prompt)) as query_span:
+            if self.cache is not None:
+                cached = self.cache.lookup(messages, params, slot)
+                if cached is not None:
+                    query_span.set(cached=True, response_chars=len(cached))
+                    return cached
+                if self.cache.offline:
+                    raise Exception(
+                        f'No recorded completion for request {self.cache.request_key(messages, params, slot)}')
+
+            response = openai.chat.completions.create(
+                # engine=self.engine_,
+                messages=messages,
+                **params)
+            query_span.set(cached=False)
 
         top_choice = response.choices[0]
         if top_choice.finish_reason != 'stop':
@@ -44,4 +143,59 @@ class GPT4:
                 f'Model did not finish properly: {top_choice.finish_reason}')
 
         response_text = top_choice.message.content
+        if self.cache is not None:
+            self.cache.store(messages, params, slot, response_text)
         return response_text
+
+    def query_openai_endpoint_samples(self, user_prompt: str, slots: List[int], temperature: float = 0.6, system_prompt: str = None) -> List[Union[str, None]]:
+        '''
+        Query the OpenAI endpoint for one sample per slot and return them in
+        the order of the slots. The samples that are not cached are drawn in
+        a single request with the n parameter and cached under their slots,
+        so they are shared with query_openai_endpoint. A sample whose
+        choice did not finish is returned as None.
+        '''
+
+        (messages, params) = self._request(user_prompt, temperature, system_prompt)
+        samples = [None for _ in slots]
+        missing = []
+        for (i, slot) in enumerate(slots):
+            if self.cache is not None:
+                samples[i] = self.cache.lookup(messages, params, slot)
+            if samples[i] is None:
+                missing.append(i)
+        if len(missing) == 0:
+            return samples
+        if self.cache is not None and self.cache.offline:
+            raise Exception(
+                f'No recorded completion for request {self.cache.request_key(messages, params, slots[missing[0]])}')
+
+        with span("llm.query", slots=len(slots), samples=len(missing), temperature=temperature, prompt_chars=len(user_prompt)):
+            response = openai.chat.completions.create(
+                messages=messages,
+                n=len(missing),
+                **params)
+
+        for (i, choice) in zip(missing, response.choices):
+            if choice.finish_reason != 'stop':
+                continue
+            samples[i] = choice.message.content
+            if self.cache is not None:
+                self.cache.store(messages, params, slots[i], samples[i])
+        return samples
+
+    @staticmethod
+    def _request(user_prompt: str, temperature: float, system_prompt: Union[str, None]):
+        messages = [{'role': 'user', 'content': user_prompt}]
+        if system_prompt is not None and system_prompt != "":
+            messages.append({'role': 'system', 'content': system_prompt})
+
+        params = {
+            'model': 'gpt-4',
+            'temperature': temperature,
+            'top_p': 1,
+            'frequency_penalty': 0,
+            'presence_penalty': 0,
+            'stop': None,
+        }
+        return (messages, params)
@@ -1,29 +1,52 @@
-import io
-import os
-import tarfile
-import tempfile
+import hashlib
+import importlib
+import random
+import struct
+import threading
+import time
 import uuid
 from ast import NodeVisitor
 from collections import OrderedDict
-from typing import List
-import textwrap
-
-import docker
-from docker.types import Ulimit
+from functools import lru_cache
+from typing import Callable, List
 
 from eywa.ast import *
+import eywa.batch as batch
+from eywa.cache import ResultStore, SeedStore, content_key
+from eywa.dfa import compile_regex
+from eywa.klee import KleeOptions, KleePool, klee_command, stream_all
+from eywa.ktest import KTest, write_ktest
 from eywa.llm import GPT4
+from eywa.trace import Tracer, record
 from termcolor import colored
 
+@lru_cache(maxsize=1)
+def decoder_version() -> str:
+    """
+    Returns a hash of the source of the modules that decode and filter KLEE
+    tests: this one, eywa.batch and eywa.ktest decode them, and eywa.ast and
+    eywa.regex evaluate the preconditions. It is part of the result store
+    key, so that any change to decoding or filtering invalidates the stored
+    inputs.
+    """
+    sources = []
+    for name in (__name__, "eywa.batch", "eywa.ktest", "eywa.ast", "eywa.regex"):
+        with open(importlib.import_module(name).__file__, "rb") as f:
+            sources.append(hashlib.sha256(f.read()).hexdigest())
+    return content_key(sources)
+
+
 class KleeOracle:
     """
     An oracle that uses the KLEE symbolic execution engine to generate
     inputs for a user's function.
     """
 
-    def __init__(self, function: Function, function_prototypes: List[Function]=None, constants: Dict[str, Const]=None, temperature: float = 0.6):
+    def __init__(self, function: Function, function_prototypes: List[Function]=None, constants: Dict[str, Const]=None, temperature: float = 0.6, slot: int = 0, regex_backend: str = 'dfa', klee_options: Union[KleeOptions, None] = None):
         """
-        Initializes the oracle with the given function.
+        Initializes the oracle with the given function. klee_options sets
+        the KLEE search heuristics and resource limits (KLEE's defaults
+        if None).
         """
         self.function = function
         self.name = function.name
@@ -39,17 +62,27 @@ class KleeOracle:
         self.function_declares = []
         self.constants = constants
         self.temperature = temperature
+        self.slot = slot
+        if regex_backend not in REGEX_BACKENDS:
+            raise Exception(f'Unknown regex backend: {regex_backend}')
+        self.regex_backend = regex_backend
+        self.decode_plan = None
+        self.precondition_fn = None
+        self.completion = None
+        self.reused = False
+        self.partition_by = None
+        self.klee_options = klee_options
+        self.use_seeds = False
+        self.seeds_used = 0
 
     def build_model(self, temperature: float = 0.0) -> None:
         """
         Builds the model by filling in the implementation field with a
         complete C program that implements the user's function.
         """
-        gpt4 = GPT4()
         user_prompt = self.user_prompt()
         print(colored("System prompt:", 'blue'), self.system_prompt())
-        gpt4_response = gpt4.query_openai_endpoint(
-            user_prompt, temperature=temperature, system_prompt=self.system_prompt())         
+        gpt4_response = self._complete(user_prompt, temperature)
         klee_main = self._build_klee_main()
         # gpt4_response = ""
         if self.precondition is not None and Expr.has_match(self.precondition):
@@ -64,7 +97,7 @@ class KleeOracle:
     def build_eywa_regex_model(self):
         lines = []
         self._build_function_definition(lines)
-        body = self.function.build_regex_expr()
+        body = self.function.build_regex_expr(self.regex_backend)
         for line in body:
             lines.append("    " + line)
         lines.append("}")
@@ -75,11 +108,9 @@ class KleeOracle:
         Builds the model by filling in the implementation field with a
         complete C program that implements the user's function.
         """
-        gpt4 = GPT4()
         print(colored("System prompt:", 'blue'), self.system_prompt())
         user_prompt = self.user_prompt()
-        gpt4_response = gpt4.query_openai_endpoint(
-            user_prompt, temperature=self.temperature, system_prompt=self.system_prompt())
+        gpt4_response = self._complete(user_prompt, self.temperature)
         # gpt4_response = ""
         print(colored("User prompt:", 'red', attrs=['bold']), user_prompt, "\n\n")
         self.implementation = gpt4_response
@@ -93,12 +124,9 @@ class KleeOracle:
         utilizes filter functions to remove unwanted test cases
         """
         
-        gpt4 = GPT4()
         user_prompt = self.user_prompt()
         print(colored("System prompt:", 'blue'), self.system_prompt())
-        gpt4_response = gpt4.query_openai_endpoint(
-            user_prompt, temperature=self.temperature, system_prompt=self.system_prompt()
-        )
+        gpt4_response = self._complete(user_prompt, self.temperature)
         # gpt4_response = ""
         if other is not None:
             klee_main = self._build_klee_filter_main(other)
@@ -110,25 +138,326 @@ class KleeOracle:
         if other is not None: self.has_valid_input_param = True
         
         
-    def get_inputs(self, timeout_sec: Union[int, None] = None):
+    def _complete(self, user_prompt: str, temperature: float) -> str:
+        """
+        Returns the LLM's implementation of the function, querying the LLM
+        unless the oracle was given a completion to reuse.
+        """
+        if self.completion is None:
+            gpt4 = GPT4()
+            self.completion = gpt4.query_openai_endpoint(
+                user_prompt, temperature=temperature, system_prompt=self.system_prompt(), slot=self.slot)
+        return self.completion
+
+    def sample_completions(self, n: int, store=None) -> List[str]:
+        """
+        Returns up to n distinct implementations of the function, the
+        completions for sample slots 0 to n - 1. Slots that are neither in
+        the ImplementationStore nor in the completion cache are sampled in
+        one batched LLM request.
+        """
+        fingerprints = [self.fingerprint(slot) for slot in range(n)]
+        completions = [None if store is None else store.lookup(f) for f in fingerprints]
+        missing = [slot for slot in range(n) if completions[slot] is None]
+        if len(missing) > 0:
+            gpt4 = GPT4()
+            samples = gpt4.query_openai_endpoint_samples(
+                self.user_prompt(), missing, temperature=self.temperature, system_prompt=self.system_prompt())
+            for (slot, completion) in zip(missing, samples):
+                completions[slot] = completion
+                if store is not None and completion is not None:
+                    store.store(fingerprints[slot], completion)
+        return list(OrderedDict.fromkeys(c for c in completions if c is not None))
+
+    def fingerprint(self, slot: Union[int, None] = None) -> str:
+        """
+        Returns a content address for the completion of this oracle. It
+        covers the instructions, the function's own types, constants,
+        docstring and signature, and the types and signatures of the
+        prototypes it may call, but not their descriptions, so editing the
+        description of a dependency does not invalidate its callers.
+        """
+        definition = []
+        self._build_type_definitions(definition)
+        self._define_constants(definition)
+        self._build_docstring(definition)
+        self._build_function_definition(definition)
+        prototypes = []
+        for fp in self.function_prototypes or []:
+            prototypes.extend(self._build_function_prototype_type_definitions(fp))
+            prototypes.append(self._build_function_prototype(fp))
+        slot = self.slot if slot is None else slot
+        return content_key(self.system_prompt(), definition, prototypes, self.temperature, slot)
+
+    def input_schema(self) -> str:
+        """
+        Returns a content address for the symbolic inputs of the program:
+        its types and the KLEE main that makes the inputs symbolic. Models
+        of the same function share a schema, so the tests KLEE found for one
+        are valid seeds for the others.
+        """
+        if self.implementation is None:
+            raise Exception('Model not built yet')
+        definition = []
+        self._build_type_definitions(definition)
+        main = self.implementation[self.implementation.rfind('int main() {'):]
+        return content_key(definition, main)
+
+    def get_inputs(self, timeout_sec: Union[int, None] = None, refresh: bool = False, batch_size: int = 0, shards: int = 0):
         """
         Gets the inputs for the user's function by using the generated
-        model and the KLEE symbolic execution engine.
+        model and the KLEE symbolic execution engine. Results are memoized
+        in the shared result store by program and KLEE command line; pass
+        refresh=True to ignore a stored result and rerun KLEE.
+        """
+        return list(self.iter_inputs(timeout_sec, refresh=refresh, batch_size=batch_size, shards=shards))
+
+    def iter_inputs(self, timeout_sec: Union[int, None] = None, refresh: bool = False, batch_size: int = 0, shards: int = 0,
+                    interrupt: Union[Callable[[float], bool], None] = None):
+        """
+        Like get_inputs, but yields the valid inputs one at a time while
+        KLEE is still running, so memory use does not grow with the number
+        of tests. Closing the generator early interrupts KLEE. With a
+        batch_size, tests are decoded and filtered that many at a time with
+        NumPy (when it is installed), which is much faster for large runs.
+        With shards > 1, the input space is split into that many disjoint
+        parts (see shard_programs) that KLEE explores concurrently on the
+        pool, and the tests of all parts are merged. With use_seeds set,
+        KLEE first replays the tests stored for the input schema by earlier
+        runs (see SeedStore), and a sample of the new tests is stored in turn.
+        interrupt is called at every KLEE poll with the time KLEE started,
+        and stops KLEE once it returns True; the tests of an interrupted run
+        are not stored.
         """
         if self.implementation is None:
             raise Exception('Model not built yet')
         self.timeout_sec = timeout_sec
-        klee_output = self._run_klee(self.implementation)
-        results = []
-        for klee_input in self._read_klee_inputs(klee_output):
+        programs = self.shard_programs(shards) if shards > 1 else [self.implementation]
+        command = klee_command(self._klee_timeout(), self.klee_options)
+        if len(programs) > 1:
+            command = f'{command} shards={len(programs)}'
+        store = ResultStore.shared()
+        writer = None
+        if store is not None:
+            key = ResultStore.key(self.implementation, command, decoder_version())
+            if not refresh:
+                cached = store.iter(key)
+                if cached is not None:
+                    record("klee.result_store_hit", time.time(), time.time(), oracle=self.name)
+                    yield from cached
+                    return
+            writer = store.writer(key)
+        # the seeds are left out of the result store key: they steer the
+        # search but any result is valid for the program and command.
+        options = self.klee_options
+        seed_store = SeedStore.shared() if self.use_seeds else None
+        if seed_store is not None:
+            schema = self.input_schema()
+            seeds = seed_store.seeds(schema)
+            self.seeds_used = len(seeds)
+            if len(seeds) > 0:
+                options = (options or KleeOptions()).with_seeds(seeds)
+        interrupted = threading.Event()
+        if interrupt is not None:
+            def stop(started):
+                if interrupt(started):
+                    interrupted.set()
+                return interrupted.is_set()
+        else:
+            stop = None
+        if len(programs) > 1:
+            records = self._unique_records(stream_all(KleePool.shared(), programs, self._klee_timeout(), options, interrupt=stop))
+        else:
+            records = KleePool.shared().stream(self.implementation, self._klee_timeout(), options, interrupt=stop)
+        if seed_store is not None:
+            records = self._collect_seeds(records, seed_store, schema)
+        if Tracer.shared() is not None:
+            inputs = self._traced_inputs(records, batch_size)
+        else:
+            inputs = self._valid_inputs(records, batch_size)
+        try:
+            for klee_input in inputs:
+                if writer is not None:
+                    writer.add(klee_input)
+                yield klee_input
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        finally:
+            inputs.close()
+            records.close()
+        if writer is not None:
+            if interrupted.is_set():
+                writer.abort()
+            else:
+                writer.commit()
+
+    @staticmethod
+    def _unique_records(records):
+        """
+        Drops the tests whose symbolic objects equal those of an earlier test.
+        """
+        seen = set()
+        try:
+            for test in records:
+                objects = tuple(test.objects)
+                if objects not in seen:
+                    seen.add(objects)
+                    yield test
+        finally:
+            records.close()
+
+    @staticmethod
+    def _collect_seeds(records, seed_store: SeedStore, schema: str, keep: int = 32):
+        """
+        Passes the tests through and, once KLEE has finished or has been
+        interrupted, stores a uniform sample of up to keep of them as seeds
+        for the schema.
+        """
+        sample = []
+        rng = random.Random(0)
+        try:
+            for (i, test) in enumerate(records):
+                if len(sample) < keep:
+                    sample.append(test)
+                else:
+                    j = rng.randrange(i + 1)
+                    if j < keep:
+                        sample[j] = test
+                yield test
+        finally:
+            records.close()
+            if len(sample) > 0:
+                seed_store.add(schema, [write_ktest(test) for test in sample])
+
+    def shard_programs(self, shards: int) -> List[str]:
+        """
+        Splits the input space of the model into up to shards disjoint
+        parts and returns one program per part, each the model with a
+        klee_assume restricting one symbolic input to its part, placed right
+        after the input is made symbolic so that KLEE never forks into the
+        other parts. The input is the first enum of the parameters (split
+        by value), else the first sized integer (split into ranges), else
+        the first character (split by residue, since the valid characters
+        are usually a narrow range), else the first boolean. Set
+        partition_by to a parameter name to only consider that parameter.
+        Returns just the model if no input can be split.
+        """
+        finder = PartitionFinder()
+        inputs = self.inputs[:-1] if isinstance(self.result.type, Void) else self.inputs
+        for parameter in inputs:
+            if not isinstance(parameter.type, Void):
+                finder.parameter = parameter.name
+                finder.visit(parameter.type)
+        leaves = [leaf for leaf in finder.leaves if self.partition_by in (None, leaf[0])]
+        for kind in (Enum, Int, Char, Bool):
+            candidates = [leaf for leaf in leaves if isinstance(leaf[1], kind)]
+            if len(candidates) > 0:
+                (_, type, var) = candidates[0]
+                break
+        else:
+            return [self.implementation]
+
+        if isinstance(type, Enum):
+            n = min(shards, len(type.values))
+            conditions = [' || '.join(f'{var} == {v}' for v in range(i, len(type.values), n)) for i in range(n)]
+        elif isinstance(type, Int):
+            n = min(shards, 2 ** type.size)
+            bounds = [(2 ** type.size * i) // n for i in range(n + 1)]
+            conditions = [f'{var} >= {bounds[i]}ULL && {var} <= {bounds[i + 1] - 1}ULL' for i in range(n)]
+        elif isinstance(type, Char):
+            n = min(shards, 256)
+            conditions = [f'((unsigned char){var}) % {n} == {i}' for i in range(n)]
+        else:
+            n = min(shards, 2)
+            conditions = [f'!{var}', var][:n]
+        if n < 2:
+            return [self.implementation]
+
+        symbolic = f'klee_make_symbolic(&{var}, sizeof({var}), "{var}");'
+        index = self.implementation.rfind(symbolic)
+        if index < 0:
+            raise Exception(f'No symbolic variable {var} in the KLEE main')
+        index += len(symbolic)
+        return [self.implementation[:index] + f'\n    klee_assume({condition});' + self.implementation[index:]
+                for condition in conditions]
+
+    def _traced_inputs(self, records: List[KTest], batch_size: int = 0):
+        """
+        Like _valid_inputs, but records a span with the time spent decoding
+        and validating tests, separately from the time spent waiting on KLEE.
+        """
+        start = time.time()
+        timing = {"klee": 0.0, "tests": 0}
+
+        def timed_records():
+            while True:
+                before = time.time()
+                try:
+                    test = next(records)
+                except StopIteration:
+                    timing["klee"] += time.time() - before
+                    return
+                timing["klee"] += time.time() - before
+                timing["tests"] += 1
+                yield test
+
+        valid = 0
+        busy = 0.0
+        inputs = self._valid_inputs(timed_records(), batch_size)
+        try:
+            while True:
+                before = time.time()
+                try:
+                    klee_input = next(inputs)
+                except StopIteration:
+                    busy += time.time() - before
+                    break
+                busy += time.time() - before
+                valid += 1
+                yield klee_input
+        finally:
+            inputs.close()
+            record("decode_validate", start, time.time(), oracle=self.name, tests=timing["tests"],
+                   valid=valid, busy_sec=max(0.0, busy - timing["klee"]), klee_wait_sec=timing["klee"])
+
+    def _valid_inputs(self, records: List[KTest], batch_size: int = 0):
+        """
+        Decodes the KLEE test records and yields the valid inputs, without
+        the validity flag of filter models.
+        """
+        if batch_size > 0 and batch.numpy_available():
+            yield from self._valid_input_batches(records, batch_size)
+            return
+        for klee_input in self._read_klee_inputs(records):
             if self._is_valid_input(klee_input):
                 if self.has_valid_input_param:
-                    if not klee_input[-1]: # checking the validity condition
-                        results.append(klee_input[:-1])
-                else: 
-                    results.append(klee_input)
-            
-        return results
+                    if klee_input[-1]: # checking the validity condition
+                        continue
+                    klee_input = klee_input[:-1]
+                yield klee_input
+
+    def _valid_input_batches(self, records: List[KTest], batch_size: int):
+        """
+        Like _valid_inputs, but evaluates the precondition column-wise over
+        batches of batch_size tests. A partial batch is flushed at the end
+        of every KLEE poll, so tests are not held back while KLEE is slow to
+        find more.
+        """
+        parameters = list(self.inputs)
+        if not isinstance(self.result.type, Void):
+            parameters.append(self.result)
+        batch_filter = batch.BatchFilter(
+            self._decode_plan(), parameters, self.precondition, self.has_valid_input_param)
+        records_batch = []
+        for record in records:
+            records_batch.append(record)
+            if len(records_batch) >= batch_size or record.poll_end:
+                yield from batch_filter.filter(records_batch)
+                records_batch = []
+        if records_batch:
+            yield from batch_filter.filter(records_batch)
 
     def _is_valid_input(self, klee_input) -> bool:
         """
@@ -138,52 +467,33 @@ class KleeOracle:
         """
         if self.precondition is None:
             return True
-        assignment = dict(
-            zip(map(lambda x: x.name, self.inputs + [self.result]), klee_input))
-        return Expr.eval(self.precondition, assignment)
+        if self.precondition_fn is None:
+            names = [parameter.name for parameter in self.inputs + [self.result]]
+            self.precondition_fn = Expr.compile(self.precondition, names)
+        return self.precondition_fn(klee_input)
 
-    def _read_klee_inputs(self, klee_output: str):
+    def _read_klee_inputs(self, records: List[KTest]):
         """
-        Reads the KLEE output and uses them to reconstruct
+        Reads the KLEE test records and uses them to reconstruct
         the values of the inputs. Yields the inputs as Python values.
         """
-        dict = {}
-        name = None
-        value = None
-        for line in klee_output.splitlines():
-            if "name:" in line:
-                name = line.split("'")[1]
-            if "uint:" in line:
-                value = int(line.split("uint: ")[1])
-                if name in dict:
-                    yield self._create_input(dict)
-                    dict = {}
-                dict[name] = value
-        yield self._create_input(dict)
-
-    def _create_input(self, dict):
-        """
-        Converts an assignment of KLEE variables in a dict
-        to a Python value.
-        """
-        # print(dict)
-        reader = ResultReader(dict)
-        inputs = []
-        
-        inp = list(self.inputs)
-        if not isinstance(self.result.type, Void): 
-            inp.append(self.result) 
-        for parameter in inp:
-            try:
-                inputs.append(reader.visit(parameter.type))
-            except:
-                inputs.append(None)
-            
-        if self.has_valid_input_param:
-            n = reader._next()
-            inputs.append(bool(reader.assignment[n]))
-        
-        return tuple(inputs)
+        plan = self._decode_plan()
+        for record in records:
+            yield plan.decode(record)
+
+    def _decode_plan(self):
+        """
+        Returns the decoding plan for this oracle's KLEE main, compiling it
+        the first time it is needed.
+        """
+        if self.decode_plan is None:
+            types = [parameter.type for parameter in self.inputs]
+            if not isinstance(self.result.type, Void):
+                types.append(self.result.type)
+            if self.has_valid_input_param:
+                types.append(Bool())
+            self.decode_plan = DecodePlan(types)
+        return self.decode_plan
 
     def _get_all_types(self) -> List[Type]:
         """
@@ -324,6 +634,21 @@ class KleeOracle:
                 
         return new_type_definitions
     
+    @staticmethod
+    def _build_function_prototype(fp):
+        (l, r) = TypeBuilder.build(fp.result.type)
+        return_type = l + r
+        parameters = []
+        # print("Inputs:", fp.inputs)
+        for i, input in enumerate(fp.inputs):
+            (left, right) = TypeBuilder.build(input.type)
+            if isinstance(fp.result.type, Void) and i == len(fp.inputs) - 1 and not isinstance(input.type, Array):
+                parameters.append(f"{left} *{input.name}")
+            else:
+                parameters.append(f"{left} {input.name}{right}")
+        
+        return f'{return_type} {fp.name}(' + ", ".join(parameters) + ');\n\n'
+    
     def _build_function_prototypes(self, result: List[str], type_definitions: List[str]):
         if self.function_prototypes is None:
             return
@@ -340,19 +665,7 @@ class KleeOracle:
                 result.append(definition)
             
         for fp in self.function_prototypes:
-            (l, r) = TypeBuilder.build(fp.result.type)
-            return_type = l + r
-            parameters = []
-            # print("Inputs:", fp.inputs)
-            for i, input in enumerate(fp.inputs):
-                (left, right) = TypeBuilder.build(input.type)
-                if isinstance(fp.result.type, Void) and i == len(fp.inputs) - 1 and not isinstance(input.type, Array):
-                    parameters.append(f"{left} *{input.name}")
-                else:
-                    parameters.append(f"{left} {input.name}{right}")
-            
-            function_definition = f'{return_type} {fp.name}(' + ", ".join(
-                parameters) + ');\n\n'
+            function_definition = self._build_function_prototype(fp)
             
             self.function_declares.append(function_definition)
             
@@ -494,6 +807,15 @@ static int match(Regex* regex, char *text) {
     cont.regex = NULL;
     return match_cont(regex, &cont, text);
 }
+
+// Match a string against a table-driven DFA starting in state 0.
+static int dfa_match(const unsigned char *classes, const unsigned short *delta, int num_classes, const unsigned char *accept, const char *text) {
+    int state = 0;
+    for (; *text != '\\0'; text++) {
+        state = delta[state * num_classes + classes[(unsigned char)*text]];
+    }
+    return accept[state];
+}
 """
 
     def _build_klee_main(self):
@@ -503,7 +825,7 @@ static int match(Regex* regex, char *text) {
         result = ["int main() {"]
         lines = []
         builder = MainBuilder(lines)
-        regex_builder = RegexBuilder(lines)
+        regex_builder = REGEX_BACKENDS[self.regex_backend](lines)
         void_builder = VoidReturnBuilder(lines)
         assignment = {}
         variables = []
@@ -676,172 +998,16 @@ static int match(Regex* regex, char *text) {
                 count += 1
         return count 
 
-    def _run_klee(self, program: str) -> str:
+    def _run_klee(self, program: str) -> List[KTest]:
         """
-        Runs KLEE given the program source code and returns the raw output
-        from the KLEE tool as a string that contains the symbolic variable assignments.
+        Runs KLEE given the program source code and returns the .ktest records
+        that contain the symbolic variable assignments of every generated test.
+        The program is run on a warm container from the shared KLEE pool.
         """
-        client = docker.from_env()
-        repository = "klee/klee"
-        tag = "3.0"
+        return KleePool.shared().run(program, self._klee_timeout())
 
-        # Check if the image already exists locally
-        local_images = [img.tags[0]
-                        for img in client.images.list() if img.tags]
-        image_name = f"{repository}:{tag}"
-        if image_name not in local_images:
-            print(f"Pulling docker image {image_name}...")
-            client.images.pull(repository, tag=tag)
-            # Will raise an exception if the image cannot be pulled
-            print(f"Successfully pulled {image_name}")
-
-        # Create a container from the image
-        container_name = f"klee_container_{self.name}"
-        ulimits = [Ulimit(name='stack', soft=-1, hard=-1)]
-        try:
-            container = client.containers.get(container_name)
-            # print(f"Container {container_name} already exists.")
-            # answer = getpass("Do you want to reuse it? (yes/no): ")
-            # if answer.lower() == "no":
-            #     new_container_name = getpass("Enter new container name: ")
-            #     container = client.containers.create(
-            #         image_name,
-            #         command="/bin/sh -c 'tail -f /dev/null'",  # keep the container running
-            #         name=new_container_name,
-            #         detach=True,
-            #         ulimits=ulimits
-            #     )
-            #     print(f"Created new container {new_container_name}.")
-        except docker.errors.NotFound:
-            container = client.containers.create(
-                image_name,
-                name=container_name,
-                command="/bin/sh -c 'tail -f /dev/null'",
-                detach=True,
-                ulimits=ulimits
-            )
-            print(f"Created new container {container_name}.")
-            container.start()
-            # Ensure the target directory exists
-            result = container.exec_run("mkdir -p /home/klee/programs")
-            if result.exit_code != 0:
-                print("Failed to create directory inside container:",
-                      result.output.decode())
-                exit(1)
-            script_content = textwrap.dedent("""\
-                import subprocess
-                import os
-                import glob
-
-                # Path to the directory containing .ktest files
-                directory_path = 'klee-last'
-                # Glob pattern to match all .ktest files
-                file_pattern = os.path.join(directory_path, '*.ktest')
-                # Output file
-                output_file = 'output.txt'
-
-                # Find all files in the directory matching the pattern
-                ktest_files = glob.glob(file_pattern)
-
-                # Open the output file in append mode
-                with open(output_file, 'w') as file:
-                    # Loop over the list of .ktest files
-                    batch = 50000
-                    batch_files = []
-                    for ktest_file in ktest_files:
-                        batch_files.append(ktest_file)
-                        batch = batch - 1
-                        if batch != 0:
-                            continue
-                        # Construct the command to execute
-                        command = ['ktest-tool'] + batch_files
-                        # Execute the command
-                        try:
-                            result = subprocess.run(command, capture_output=True, text=True, check=True)
-                            file.write(f"{result.stdout}")
-                        except subprocess.CalledProcessError as e:
-                            file.write(f"Command failed for {ktest_file}: {e}")
-                        batch = 50000
-                        batch_files = []
-                    if batch_files:
-                        command = ['ktest-tool'] + batch_files
-                        try:
-                            result = subprocess.run(command, capture_output=True, text=True, check=True)
-                            file.write(f"{result.stdout}")
-                        except subprocess.CalledProcessError as e:
-                            file.write(f"Command failed for {ktest_file}: {e}")                                       
-                """)
-            container_path = '/home/klee/programs/'
-            # Create a temporary tar archive in memory
-            tar_stream = io.BytesIO()
-            with tarfile.open(fileobj=tar_stream, mode='w') as tar:
-                tarinfo = tarfile.TarInfo(name="script.py")
-                tarinfo.size = len(script_content)
-                tarinfo.mtime = tarinfo.mode = 0o755  # Ensure the file is executable
-                tar.addfile(tarinfo, io.BytesIO(
-                    script_content.encode('utf-8')))
-            # Go back to the beginning of the BytesIO stream
-            tar_stream.seek(0)
-            container.put_archive(container_path, tar_stream)
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            exit(1)
-        container.start()
-
-        # Write program to a temporary file
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp:
-            temp.write(program)
-            temp_filename = temp.name
-
-        # Create a temporary tarfile
-        with tempfile.NamedTemporaryFile(suffix=".tar", delete=False) as tar_temp:
-            with tarfile.open(tar_temp.name, 'w') as tar:
-                tar.add(temp_filename, arcname="test.c")
-            tar_temp_filename = tar_temp.name
-
-        # Copy tarfile to the container
-        with open(tar_temp_filename, 'rb') as data:
-            container.put_archive('/home/klee/programs', data)
-
-        # Cleanup temporary files
-        os.remove(temp_filename)
-        os.remove(tar_temp_filename)
-
-        # run the clang command
-        _, output = container.exec_run(
-            "/bin/bash -c 'cd /home/klee/programs && sudo chmod a+r test.c && clang -emit-llvm -g -c test.c -o test.bc'")
-        clang_output = output.decode('utf-8')
-        if "error" in clang_output or "Error" in clang_output:
-            raise Exception(
-                f'Unable to compile generated program with error\n{clang_output}')
-
-        # run the klee command
-        timeout = 5 if self.timeout_sec is None else self.timeout_sec
-        _, output = container.exec_run(
-            f"/bin/bash -c 'cd /home/klee/programs && klee --libc=uclibc --posix-runtime -max-time={timeout}s --external-calls=all test.bc'")
-        klee_output = output.decode('utf-8')
-        if 'KLEE: done:' not in klee_output:
-            raise Exception(f'KLEE execution failed with error\n{klee_output}')
-
-        result = container.exec_run(
-            "/bin/bash -c 'cd /home/klee/programs && python3 script.py'")
-        if result.exit_code != 0:
-            print("Failed to run the test-tool script inside container:",
-                  result.output.decode())
-            exit(1)
-        stream, _ = container.get_archive("/home/klee/programs/output.txt")
-        file_like_object = io.BytesIO()
-        for chunk in stream:
-            file_like_object.write(chunk)
-        file_like_object.seek(0)
-        with tarfile.open(fileobj=file_like_object, mode='r|') as tar:
-            # Assuming there's only one file in the tar archive, extract its content
-            for member in tar:
-                f = tar.extractfile(member)
-                if f is not None:
-                    ktest_output = f.read().decode('utf-8')
-        # print("KTest Output:", ktest_output)
-        return ktest_output
+    def _klee_timeout(self) -> int:
+        return 5 if self.timeout_sec is None else self.timeout_sec
 
 
 class TypeBuilder(NodeVisitor):
@@ -1080,6 +1246,38 @@ class MainBuilder(NodeVisitor):
     def visit_Alias(self, node):
         return self.visit(node.type)
     
+class PartitionFinder(MainBuilder):
+    """
+    Numbers the symbolic variables of the KLEE main like MainBuilder, and
+    records every enum, sized integer, character and boolean input as a
+    (parameter name, type, variable) leaf that the input space can be
+    split on.
+    """
+
+    def __init__(self):
+        super().__init__([])
+        self.parameter = None
+        self.leaves = []
+
+    def _leaf(self, node, var):
+        self.leaves.append((self.parameter, node, var))
+        return var
+
+    def visit_Bool(self, node):
+        return self._leaf(node, super().visit_Bool(node))
+
+    def visit_Char(self, node):
+        return self._leaf(node, super().visit_Char(node))
+
+    def visit_Int(self, node):
+        var = super().visit_Int(node)
+        if node.size in (8, 16, 32, 64):
+            self._leaf(node, var)
+        return var
+
+    def visit_Enum(self, node):
+        return self._leaf(node, super().visit_Enum(node))
+    
 class VoidReturnBuilder(NodeVisitor):
     def __init__(self, result):
         self.result = result
@@ -1137,73 +1335,104 @@ class VoidReturnBuilder(NodeVisitor):
         self.result.extend(self.new_lines)
     
     
-class ResultReader(NodeVisitor):
+class DecodePlan:
     """
-    Class to read the results of a KLEE run and convert them to Python values.
+    A flat decoding plan for the symbolic objects of a KLEE main, compiled
+    once from the Eywa types of the parameters. The leaves of the types are
+    laid out in the order the main creates them, so a test is decoded with a
+    single struct.unpack over its concatenated object bytes followed by a
+    precompiled closure per parameter.
     """
 
-    def __init__(self, assignment: Dict[str, int]):
-        self.number = 0
-        self.assignment = assignment
-        self.mx = 0
-        for key in assignment:
-            self.mx = max(int(key[-1]), self.mx)
-        
-    def _lookup(self):
-        n = self._next()
-        while n not in self.assignment:
-            n = self._next()
-            if int(n[-1]) > self.mx:
-                break
-        if n in self.assignment:
-            return self.assignment[n]
-        raise Exception("Invalid assignment")
+    def __init__(self, types: List[Type]):
+        builder = DecoderBuilder()
+        self.parameters = []
+        for type in types:
+            build = builder.visit(type)
+            self.parameters.append((len(builder.formats), build))
+        self.count = len(builder.formats)
+        self.struct = struct.Struct('<' + ''.join(builder.formats))
 
-    def _next(self):
-        n = self.number
-        self.number = self.number + 1
-        return f'x{n}'
+    @staticmethod
+    def _objects(record: KTest) -> List[bytes]:
+        """
+        Returns the bytes of the x<n> variables created by the KLEE main.
+        """
+        return [data for (name, data) in record.objects if name[:1] == 'x' and name[1:].isdigit()]
+
+    def _build(self, values) -> tuple:
+        result = []
+        for (end, build) in self.parameters:
+            if end > len(values):
+                result.append(None)
+                continue
+            try:
+                result.append(build(values))
+            except Exception:
+                result.append(None)
+        return tuple(result)
+
+    def decode(self, record: KTest) -> tuple:
+        """
+        Decodes one test into a tuple of Python values, with None for any
+        parameter that could not be decoded.
+        """
+        objects = self._objects(record)
+        data = b''.join(objects)
+        if len(objects) == self.count and len(data) == self.struct.size:
+            return self._build(self.struct.unpack(data))
+        # slow path for unexpected layouts: decode the objects that exist.
+        return self._build([int.from_bytes(d, 'little') for d in objects[:self.count]])
+
+
+class DecoderBuilder(NodeVisitor):
+    """
+    A class that compiles an Eywa type into struct format codes for its
+    leaves and a closure that builds the Python value from unpacked leaves.
+    """
+
+    def __init__(self):
+        self.formats = []
+
+    def _leaf(self, format: str) -> int:
+        self.formats.append(format)
+        return len(self.formats) - 1
 
     def visit_Void(self, node):
         raise Exception('Cannot create an instance of the Void type')
 
     def visit_Bool(self, node):
-        return bool(self._lookup())
+        i = self._leaf('?')
+        return lambda values: values[i]
 
     def visit_Char(self, node):
-        return chr(self._lookup())
+        i = self._leaf('B')
+        return lambda values: chr(values[i])
 
     def visit_Int(self, node):
-        return int(self._lookup())
+        format = {64: 'Q', 32: 'I', 16: 'H', 8: 'B'}.get(node.size, 'I')
+        i = self._leaf(format)
+        return lambda values: values[i]
 
     def visit_String(self, node):
-        self._next()  # char[] variable
-        str = ""
-        done = False
+        start = len(self.formats)
         for _ in range(0, node.maxsize):
-            c = self.visit(node.char_type)
-            if c == '\0':
-                done = True
-            if not done:
-                str = str + c
-        return str
+            self._leaf('B')
+        end = len(self.formats)
+        return lambda values: bytes(values[start:end]).split(b'\0', 1)[0].decode('latin-1')
 
     def visit_Enum(self, node):
-        return node.values[self._lookup()]
+        i = self._leaf('I')
+        enum_values = node.values
+        return lambda values: enum_values[values[i]]
 
     def visit_Array(self, node):
-        self._next()  # array variable
-        result = []
-        for _ in range(0, node.maxsize):
-            result.append(self.visit(node.element_type))
-        return tuple(result)
+        elements = [self.visit(node.element_type) for _ in range(0, node.maxsize)]
+        return lambda values: tuple(element(values) for element in elements)
 
     def visit_Struct(self, node):
-        self._next()  # struct variable
-        result = {}
-        for (field_name, field) in node.fields.items():
-            result[field_name] = self.visit(field)
-        return result
+        fields = [(field_name, self.visit(field)) for (field_name, field) in node.fields.items()]
+        return lambda values: {field_name: build(values) for (field_name, build) in fields}
 
     def visit_Alias(self, node):
         return self.visit(node.type)
@@ -1293,6 +1522,14 @@ class RegexBuilder(NodeVisitor):
             var1 = var3
         return var1
 
+    def match(self, regex: re.Regex, text: str) -> str:
+        """
+        Builds the regex and returns a C expression that matches text against it.
+        """
+        var = self.visit(regex)
+        var = "NULL" if var == "NULL" else f'&{var}'
+        return f'match({var}, {text})'
+
     def visit_Range(self, node):
         return self._range(node.low, node.high)
 
@@ -1314,6 +1551,35 @@ class RegexBuilder(NodeVisitor):
         return var
 
 
+class DfaRegexBuilder:
+    """
+    A class to build a table-driven C matcher for a given Eywa regex. The
+    regex is compiled to a minimized DFA whose tables are declared as local
+    constants, so matching is a single loop instead of a backtracking
+    search that KLEE has to fork on at every alternative.
+    """
+
+    def __init__(self, result: List[str]):
+        self.result = result
+        self.number = 0
+
+    def match(self, regex: re.Regex, text: str) -> str:
+        """
+        Declares the DFA tables and returns a C expression that matches text.
+        """
+        name = f'dfa{self.number}'
+        self.number = self.number + 1
+        dfa = compile_regex(regex)
+        self.result.extend(dfa.c_tables(name))
+        return dfa.c_match(name, text)
+
+
+REGEX_BACKENDS = {
+    'dfa': DfaRegexBuilder,
+    'backtracking': RegexBuilder,
+}
+
+
 class ExprConverter(NodeVisitor):
     """
     A class that converts an Expr to C code.
@@ -1356,9 +1622,7 @@ class ExprConverter(NodeVisitor):
         """
         Visits a match expression and returns the corresponding C code.
         """
-        var = self.regex_builder.visit(node.regex)
-        var = "NULL" if var == "NULL" else f'&{var}'
-        return f'match({var}, {self.visit(node.expr)})'
+        return self.regex_builder.match(node.regex, self.visit(node.expr))
 
     def visit_Not(self, node):
         """
@@ -1498,12 +1762,11 @@ class RegexModule(Function):
         return self.regex_parser(regex)
         
     
-    def build_regex_expr(self):
+    def build_regex_expr(self, backend: str = 'dfa'):
         lines = []
-        regex_builder = RegexBuilder(lines)
+        regex_builder = REGEX_BACKENDS[backend](lines)
         # print("Regex string:" , self.regex_str)
-        regex_builder.visit(self.get_regex())
+        match = regex_builder.match(self.get_regex(), self.inputs[0].name)
         #print("Input parameter name:", self.inputs[0].name)
-        final_variable = 'r' + str(regex_builder.number - 1)
-        lines.append(f'return match(&{final_variable}, {self.inputs[0].name});')
+        lines.append(f'return {match};')
         return lines
\ No newline at end of file
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import List
 import re
 
@@ -6,7 +7,32 @@ class Regex(object):
     """
     A regular expression.
     """
-    pass
+
+    def pattern(self) -> str:
+        """
+        Returns the Python regular expression syntax for this regex, with
+        range bounds escaped.
+        """
+        return str(self)
+
+    def matcher(self):
+        """
+        Returns the compiled Python pattern for this regex. It is built the
+        first time it is needed and memoized on the node.
+        """
+        compiled = self.__dict__.get('_compiled')
+        if compiled is None:
+            compiled = _compile(self.pattern())
+            self._compiled = compiled
+        return compiled
+
+
+@lru_cache(maxsize=512)
+def _compile(pattern: str):
+    """
+    Compiles a pattern, shared between structurally identical regexes.
+    """
+    return re.compile(pattern)
 
 
 class Empty(Regex):
@@ -32,6 +58,9 @@ class Range(Regex):
     def __str__(self) -> str:
         return f'[{self.low}-{self.high}]'
 
+    def pattern(self) -> str:
+        return f'[{re.escape(self.low)}-{re.escape(self.high)}]'
+
 
 class Choice(Regex):
     """
@@ -46,6 +75,9 @@ class Choice(Regex):
     def __str__(self) -> str:
         return f'({"|".join([str(e) for e in self.exprs])})'
 
+    def pattern(self) -> str:
+        return f'({"|".join([e.pattern() for e in self.exprs])})'
+
 
 class Seq(Regex):
     """
@@ -60,6 +92,9 @@ class Seq(Regex):
     def __str__(self) -> str:
         return f'({"".join([str(e) for e in self.exprs])})'
 
+    def pattern(self) -> str:
+        return f'({"".join([e.pattern() for e in self.exprs])})'
+
 
 class Star(Regex):
     """
@@ -72,6 +107,9 @@ class Star(Regex):
     def __str__(self) -> str:
         return f'({str(self.expr)})*'
 
+    def pattern(self) -> str:
+        return f'({self.expr.pattern()})*'
+
 
 def chars(low: str, high: str) -> Regex:
     """
@@ -131,5 +169,12 @@ def ismatch(r: Regex, s: str) -> bool:
     """
     Determine if a string matches a regular expression.
     """
-    regex = '^' + str(r) + '$'
-    return re.match(regex, s) is not None
+    return r.matcher().fullmatch(s) is not None
+
+
+def ismatch_many(r: Regex, strings: List[str]) -> List[bool]:
+    """
+    Determine for each of a list of strings if it matches a regular expression.
+    """
+    fullmatch = r.matcher().fullmatch
+    return [fullmatch(s) is not None for s in strings]
@@ -1,12 +1,17 @@
 import json
+import math
 import os
+import threading
 import time
 import traceback
-from collections import defaultdict
-from typing import Union
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
 from eywa.composer import DependencyGraph
 import eywa.ast as ast
 import eywa.oracles as oracles
+from eywa.klee import KleeOptions, KleePool, KleeRuntime
+from eywa.trace import Tracer, in_context, span
 
 def generate_temperature_values(k):
     if k == 1:
@@ -34,72 +39,373 @@ def recreate_structure(hashable):
         return hashable
 
 
-def run(graph: DependencyGraph, k: int = 1, ratelimit_sec=10, debug: Union[None, str] = None, timeout_sec: int = 300, temperature_value=0.6):
+class TokenBucket:
+    """
+    A thread-safe token bucket used to rate limit model synthesis. Tokens are
+    refilled continuously at the given rate up to capacity, so short bursts are
+    allowed while the long-run request rate stays bounded.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and consumes it.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SaturationMonitor:
+    """
+    Decides when a KLEE run has stopped finding new tests: saturated()
+    turns (and stays) True once at most rate tests per second new to the
+    whole run have been found over the last window_sec seconds, with the
+    first window starting when KLEE started (after compilation). It is
+    polled by the KLEE worker thread while the exploring thread reports
+    tests, so it is thread-safe.
+    """
+
+    def __init__(self, window_sec: float, rate: float = 0.0):
+        self.window_sec = window_sec
+        self.rate = rate
+        self.start = None
+        self.found = deque()
+        self.saturated_at = None
+        self.lock = threading.Lock()
+
+    def add(self) -> None:
+        """
+        Records the discovery of a new unique test.
+        """
+        with self.lock:
+            self.found.append(time.time())
+
+    def saturated(self, started: Union[float, None] = None) -> bool:
+        """
+        Returns whether the run is saturated, given the time KLEE started.
+        """
+        with self.lock:
+            if self.saturated_at is not None:
+                return True
+            now = time.time()
+            if self.start is None:
+                self.start = started if started is not None else now
+            if now - self.start < self.window_sec:
+                return False
+            while self.found and self.found[0] < now - self.window_sec:
+                self.found.popleft()
+            if len(self.found) <= self.rate * self.window_sec:
+                self.saturated_at = now
+                return True
+            return False
+
+
+class TemperatureBandit:
+    """
+    A UCB1 bandit over sampling temperatures, rewarding each temperature
+    with the unique tests per second its models added. Untried temperatures
+    are chosen first, in order; after that, the one with the highest mean
+    reward plus an exploration bonus, scaled by the best mean seen so far
+    since the rewards are not bounded. A model that has been chosen but not
+    yet rewarded counts as a pull, so concurrent choices spread out.
+    """
+
+    def __init__(self, temperatures: List[float]):
+        if len(temperatures) == 0:
+            raise Exception('The bandit needs at least one temperature')
+        self.temperatures = list(temperatures)
+        self.pulls = {t: 0 for t in self.temperatures}
+        self.rewarded = {t: 0 for t in self.temperatures}
+        self.rewards = {t: 0.0 for t in self.temperatures}
+        self.lock = threading.Lock()
+
+    def _mean(self, temperature: float) -> float:
+        return self.rewards[temperature] / self.rewarded[temperature] if self.rewarded[temperature] > 0 else 0.0
+
+    def choose(self) -> float:
+        with self.lock:
+            untried = [t for t in self.temperatures if self.pulls[t] == 0]
+            if untried:
+                choice = untried[0]
+            else:
+                total = sum(self.pulls.values())
+                scale = max(max(self._mean(t) for t in self.temperatures), 1e-9)
+                choice = max(self.temperatures, key=lambda t: self._mean(t) + scale * math.sqrt(2 * math.log(total) / self.pulls[t]))
+            self.pulls[choice] += 1
+            return choice
+
+    def update(self, temperature: float, reward: float) -> None:
+        with self.lock:
+            self.rewarded[temperature] += 1
+            self.rewards[temperature] += reward
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {str(t): {"models": self.pulls[t], "unique_tests_per_sec": self._mean(t)} for t in self.temperatures}
+
+
+def run(graph: DependencyGraph, k: int = 1, ratelimit_sec=10, debug: Union[None, str] = None, timeout_sec: int = 300, temperature_value=0.6, max_in_flight: int = 4, klee_workers: int = 1, burst: int = 1, retry_sec: int = 120, refresh: bool = False, batch_size: int = 0, regex_backend: str = 'dfa', trace: Union[None, str] = None, samples: int = 0, shards: int = 0, klee_options: Union[None, str, KleeOptions] = None, seeds: bool = False, saturation_window_sec: float = 0, saturation_rate: float = 0.0, budget_sec: float = 0, temperatures: Union[None, List[float]] = None):
     """
     Run a model to produce test results.
+
+    Models are synthesized one after another by the calling thread, rate
+    limited to one synthesis per ratelimit_sec (with bursts of up to burst),
+    and each model is handed to one of klee_workers warm KLEE containers as
+    soon as it is available, so LLM latency and KLEE time overlap. Each
+    model's tests are deduplicated as KLEE produces them and merged into the
+    set of unique tests once its KLEE run succeeds. KLEE results for a
+    program that was already explored with the same options are read back
+    from the result store unless refresh is set. A nonzero batch_size
+    filters KLEE tests in vectorized batches of that size, and
+    regex_backend selects how regex matches are compiled to C.
+
+    With shards > 1, KLEE explores every model as that many disjoint
+    parts of its input space at once (see KleeOracle.shard_programs), on a
+    pool of klee_workers * shards containers.
+
+    klee_options sets the KLEE search heuristics and resource limits of
+    every model, either as KleeOptions or as the name of a preset
+    ('default', 'throughput' or 'coverage'); the options are recorded in
+    the stats.
+
+    With seeds set, KLEE starts each model from tests found by earlier
+    runs of models with the same inputs, within this call and across
+    calls (see SeedStore; EYWA_SEEDS=0 turns the store off), so later
+    runs skip the shallow paths and go deeper. The number of seeds each
+    run replayed is recorded in the stats.
+
+    With samples > 0, the graph is synthesized once with that many LLM
+    samples per node, drawn in one batched request per node, and the k
+    models are distinct combinations of the samples (fewer if there are
+    not k distinct programs), see DependencyGraph.synthesize_samples.
+
+    With saturation_window_sec > 0, KLEE is interrupted once a model has
+    found at most saturation_rate tests per second that are new to the
+    whole run over the last saturation_window_sec seconds (see
+    SaturationMonitor). The KLEE time left unused is recorded per model
+    as Budget_Saved_Sec in the stats, and in total as budget_saved_sec.
+
+    With budget_sec > 0, the run adapts to the models instead: models are
+    synthesized until budget_sec seconds of wall time are used up (or k
+    models have been synthesized, which bounds the LLM cost), and each
+    one is sampled at the temperature, out of temperatures, chosen by a
+    TemperatureBandit from the Unique_Tests_Added per second of synthesis
+    and KLEE time of the earlier models. Productive temperatures thus get
+    more LLM samples and KLEE time. KLEE is given at most the remaining
+    budget, and at most klee_workers + 1 models are synthesized but not yet
+    explored, so every choice sees recent rewards. The bandit's counts
+    are recorded in the stats.
+
+    If trace (or the EYWA_TRACE environment variable) is set to a path
+    prefix, the run is traced and the spans are written to <trace>.jsonl
+    and, in Chrome trace format, to <trace>.chrome.json.
     """
+    if budget_sec > 0 and samples > 0:
+        raise Exception('A budget cannot be combined with batched samples')
     if debug is not None:
         if not os.path.exists(debug):
             os.makedirs(debug)
     unique_testcases = set()
     temperature_values = [temperature_value for _ in range(k)]
     stats = defaultdict(lambda: defaultdict(float))
-    for i in range(k):
-        if i > 0:
-            time.sleep(ratelimit_sec)
+    bucket = TokenBucket(1 / ratelimit_sec if ratelimit_sec > 0 else 0, capacity=burst)
+    merge_lock = threading.Lock()
+    KleePool.configure(klee_workers * max(1, shards))
+    if isinstance(klee_options, str):
+        klee_options = KleeOptions.preset(klee_options)
+    stats["klee_options"] = (klee_options or KleeOptions()).to_dict()
+    if trace is None:
+        trace = os.environ.get("EYWA_TRACE")
+    tracer = Tracer.start() if trace else None
+
+    def synthesize(i):
+        with span("run.synthesize", run=i, temperature=temperature_values[i]):
+            return synthesize_model(i)
+
+    def synthesize_model(i):
+        bucket.acquire()
         start_time = time.time()
         # oracle = oracles.KleeOracle(model)
         try:
             # oracle.build_model(temperature=temperature_values[i])
-            model = graph.Synthesize(temperature=temperature_values[i])
+            model = graph.Synthesize(temperature=temperature_values[i], slot=i, max_in_flight=max_in_flight, regex_backend=regex_backend)
         except Exception as e:
             print(
                 f"Error building model with temperature {temperature_values[i]}: {e}")
-            time.sleep(120)
+            time.sleep(retry_sec)
+            bucket.acquire()
             start_time = time.time()
             # oracle.build_model(temperature=temperature_values[i])
-            model = graph.Synthesize(temperature=temperature_values[i])
+            model = graph.Synthesize(temperature=temperature_values[i], slot=i, max_in_flight=max_in_flight, regex_backend=regex_backend)
         stats[i]["GPT_Time"] = time.time() - start_time
-        system_prompt = model.system_prompt()
-        user_prompt = model.user_prompt()
-        implementation = model.implementation
+        save(i, model)
+        return model
+
+    def synthesize_samples():
+        with span("run.synthesize", samples=samples, temperature=temperature_value):
+            bucket.acquire()
+            start_time = time.time()
+            try:
+                models = graph.synthesize_samples(samples, k, temperature=temperature_value, max_in_flight=max_in_flight, regex_backend=regex_backend)
+            except Exception as e:
+                print(
+                    f"Error sampling models with temperature {temperature_value}: {e}")
+                time.sleep(retry_sec)
+                bucket.acquire()
+                start_time = time.time()
+                models = graph.synthesize_samples(samples, k, temperature=temperature_value, max_in_flight=max_in_flight, regex_backend=regex_backend)
+        for i, model in enumerate(models):
+            stats[i]["GPT_Time"] = (time.time() - start_time) / len(models)
+            save(i, model)
+        return models
+
+    def save(i, model):
         if debug is not None:
             if i == 0:
                 with open(os.path.join(debug, f"system_prompt.txt"), "w") as f:
-                    f.write(system_prompt)
+                    f.write(model.system_prompt())
                 with open(os.path.join(debug, f"user_prompt.txt"), "w") as f:
-                    f.write(user_prompt)
-            with open(os.path.join(debug, f"implementation_{i}_{temperature_value}.c"), "w") as f:
-                f.write(implementation)
+                    f.write(model.user_prompt())
+            with open(os.path.join(debug, f"implementation_{i}_{temperature_values[i]}.c"), "w") as f:
+                f.write(model.implementation)
+
+    def explore(i, model, timeout=timeout_sec):
+        with span("run.explore", run=i) as explore_span:
+            explore_model(i, model, explore_span, timeout)
+
+    def explore_model(i, model, explore_span, timeout):
+        implementation = model.implementation
+        if klee_options is not None:
+            model.klee_options = klee_options
+        model.use_seeds = seeds
+        tests_file = None
         try:
+            if debug is not None:
+                tests_file = open(os.path.join(debug, f"tests_{i}_{temperature_values[i]}.txt"), "w")
             start_time = time.time()
-            tests = model.get_inputs(timeout_sec)
-            stats[i]["Klee_Time"] = time.time() - start_time
-            strings = []
+            num_tests = 0
             unique_testcases_i = set()
-            for test in tests:
-                unique_testcases_i.add(make_hashable(test))
-                strings.append(str(test))
-            stats[i]["Num_Tests"] = len(strings)
-            stats[i]["Num_Unique_Tests"] = len(unique_testcases_i)
-            stats[i]["Implementation_Lines"] = len(implementation.split("\n"))
-            unique_testcases_before = len(unique_testcases)
-            for testcase in unique_testcases_i:
-                unique_testcases.add(testcase)
-            stats[i]["Unique_Tests_Added"] = len(
-                unique_testcases) - unique_testcases_before
-            stats[i]["Total_Unique_Tests"] = len(unique_testcases)
+            monitor = SaturationMonitor(saturation_window_sec, saturation_rate) if saturation_window_sec > 0 else None
+            interrupt = monitor.saturated if monitor is not None else None
+            # tests are deduplicated and written out as KLEE produces them,
+            # but only merged into the run's tests once KLEE has succeeded.
+            for test in model.iter_inputs(timeout, refresh=refresh, batch_size=batch_size, shards=shards, interrupt=interrupt):
+                testcase = make_hashable(test)
+                if testcase not in unique_testcases_i:
+                    unique_testcases_i.add(testcase)
+                    if monitor is not None:
+                        with merge_lock:
+                            new = testcase not in unique_testcases
+                        if new:
+                            monitor.add()
+                if tests_file is not None:
+                    tests_file.write(("\n" if num_tests > 0 else "") + str(test))
+                num_tests += 1
+            klee_time = time.time() - start_time
+            saturated = monitor is not None and monitor.saturated_at is not None
+            budget_saved = max(0.0, timeout - klee_time) if saturated else 0.0
+            explore_span.set(tests=num_tests, unique_tests=len(unique_testcases_i), budget_saved_sec=budget_saved)
+            with merge_lock:
+                new_testcases = unique_testcases_i - unique_testcases
+                unique_testcases.update(new_testcases)
+                unique_tests_added = len(new_testcases)
+                stats[i]["Klee_Time"] = klee_time
+                stats[i]["Num_Tests"] = num_tests
+                stats[i]["Num_Unique_Tests"] = len(unique_testcases_i)
+                stats[i]["Implementation_Lines"] = len(implementation.split("\n"))
+                stats[i]["Unique_Tests_Added"] = unique_tests_added
+                stats[i]["Total_Unique_Tests"] = len(unique_testcases)
+                stats[i]["Seeds"] = model.seeds_used
+                stats[i]["Budget_Saved_Sec"] = budget_saved
+            if saturated:
+                print(f"Stopped KLEE in run {i} after {klee_time:.0f}s, saving {budget_saved:.0f}s: "
+                      f"no more than {saturation_rate} new tests/s in {saturation_window_sec}s.", flush=True)
             if debug is not None:
-                with open(os.path.join(debug, f"tests_{i}_{temperature_value}.txt"), "w") as f:
-                    f.write("\n".join(strings))
                 print(
-                    f"Generated {len(strings)} test cases in run {i} with temp {temperature_value}.", flush=True)
+                    f"Generated {num_tests} test cases in run {i} with temp {temperature_values[i]}.", flush=True)
         except Exception as e:
             if debug is not None:
-                with open(os.path.join(debug, f"errors_{i}_{temperature_value}.txt"), "w") as f:
+                with open(os.path.join(debug, f"errors_{i}_{temperature_values[i]}.txt"), "w") as f:
                     f.write(str(e) + "\n")
                     traceback.print_exc(file=f)
+        finally:
+            if tests_file is not None:
+                tests_file.close()
+
+    def explore_within_budget(i, model, bandit, pending, deadline):
+        try:
+            timeout = max(1, int(min(timeout_sec, deadline - time.monotonic())))
+            explore(i, model, timeout)
+            with merge_lock:
+                spent = stats[i]["GPT_Time"] + stats[i]["Klee_Time"]
+                reward = stats[i]["Unique_Tests_Added"] / spent if spent > 0 else 0.0
+            bandit.update(temperature_values[i], reward)
+        finally:
+            pending.release()
+
+    # the trace is written even if the run fails, since that is when it is
+    # needed most.
+    try:
+        with span("run", k=k), ThreadPoolExecutor(max_workers=max(1, klee_workers)) as executor:
+            futures = []
+            if budget_sec > 0:
+                deadline = time.monotonic() + budget_sec
+                bandit = TemperatureBandit(temperatures or [0.2, 0.4, 0.6, 0.8, 1.0])
+                pending = threading.Semaphore(klee_workers + 1)
+                for i in range(k):
+                    pending.acquire()
+                    if deadline - time.monotonic() < 1:
+                        pending.release()
+                        break
+                    temperature_values[i] = bandit.choose()
+                    stats[i]["Temperature"] = temperature_values[i]
+                    try:
+                        model = synthesize(i)
+                    except BaseException:
+                        pending.release()
+                        raise
+                    futures.append(executor.submit(in_context(explore_within_budget), i, model, bandit, pending, deadline))
+            elif samples > 0:
+                for i, model in enumerate(synthesize_samples()):
+                    futures.append(executor.submit(in_context(explore), i, model))
+            else:
+                for i in range(k):
+                    model = synthesize(i)
+                    futures.append(executor.submit(in_context(explore), i, model))
+            for future in futures:
+                future.result()
+    finally:
+        if tracer is not None:
+            Tracer.stop()
+            stats["trace"] = tracer.summary()
+            tracer.export_jsonl(f"{trace}.jsonl")
+            tracer.export_chrome(f"{trace}.chrome.json")
+    if budget_sec > 0:
+        stats["bandit"] = bandit.stats()
+        print("Unique tests per second by temperature:", stats["bandit"], flush=True)
+
     unique_tuples_list = [recreate_structure(t) for t in unique_testcases]
-    with open(os.path.join(debug, f"stats_{temperature_value}.json"), "w") as f:
-        json.dump(stats, f, indent=2)
+    if saturation_window_sec > 0:
+        stats["budget_saved_sec"] = sum(run_stats["Budget_Saved_Sec"] for (i, run_stats) in list(stats.items()) if isinstance(i, int))
+    if KleeRuntime.current() is not None:
+        stats["runtime"] = KleeRuntime.current().stats()
+    if debug is not None:
+        with open(os.path.join(debug, f"stats_{'adaptive' if budget_sec > 0 else temperature_value}.json"), "w") as f:
+            json.dump(stats, f, indent=2)
     return unique_tuples_list
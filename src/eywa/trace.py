@@ -0,0 +1,204 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Union
+
+_current_span = contextvars.ContextVar("eywa_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """
+    A timed section of work with a name, attributes and a parent span.
+    """
+
+    def __init__(self, name: str, parent: Union["Span", None], attributes: Dict[str, Any]):
+        self.id = next(_span_ids)
+        self.name = name
+        self.parent_id = parent.id if parent is not None else None
+        self.thread = threading.get_ident()
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+
+    def set(self, **attributes) -> None:
+        """
+        Adds attributes to the span.
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.end - self.start,
+            "thread": self.thread,
+            "attributes": self.attributes,
+        }
+
+
+class _NullSpan:
+    """
+    The span handed out when tracing is off; it ignores attributes.
+    """
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NULL_CONTEXT = nullcontext(_NullSpan())
+
+
+class Tracer:
+    """
+    Collects the spans of a run. Spans nest through a context variable, so a
+    span opened inside another one (in the same thread, or in a task
+    submitted with contextvars.copy_context()) becomes its child. Tracing
+    is off unless a tracer has been started; while it is off, span() is a
+    no-op that costs a single attribute lookup.
+    """
+
+    _shared = None
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def start():
+        """
+        Starts collecting spans in a new process-wide tracer and returns it.
+        """
+        Tracer._shared = Tracer()
+        return Tracer._shared
+
+    @staticmethod
+    def stop() -> None:
+        Tracer._shared = None
+
+    @staticmethod
+    def shared():
+        """
+        Returns the process-wide tracer, or None when tracing is off.
+        """
+        return Tracer._shared
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time.time()
+            with self._lock:
+                self.spans.append(span)
+
+    def record(self, name: str, start: float, end: float, **attributes) -> None:
+        """
+        Records a span that has already finished, as a child of the current
+        span. This is for work interleaved with a consumer, like a
+        generator, where a context manager cannot stay open.
+        """
+        span = Span(name, _current_span.get(), attributes)
+        span.start = start
+        span.end = end
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the number of spans and their total duration per name.
+        """
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                total = totals.setdefault(span.name, {"count": 0, "total_sec": 0.0})
+                total["count"] += 1
+                total["total_sec"] += span.end - span.start
+        return totals
+
+    def export_jsonl(self, path: str) -> None:
+        """
+        Writes one JSON object per span, in the order the spans ended.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, "w") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    def export_chrome(self, path: str) -> None:
+        """
+        Writes the spans in the Chrome trace event format, which can be
+        opened in chrome://tracing or https://ui.perfetto.dev.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = [{
+            "name": span.name,
+            "cat": "eywa",
+            "ph": "X",
+            "ts": span.start * 1e6,
+            "dur": (span.end - span.start) * 1e6,
+            "pid": pid,
+            "tid": span.thread,
+            "args": {key: str(value) for (key, value) in span.attributes.items()},
+        } for span in sorted(spans, key=lambda s: s.start)]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def span(name: str, **attributes):
+    """
+    Returns a context manager that times the enclosed block as a span of
+    the current tracer, or does nothing when tracing is off.
+    """
+    tracer = Tracer._shared
+    if tracer is None:
+        return _NULL_CONTEXT
+    return tracer.span(name, **attributes)
+
+
+def record(name: str, start: float, end: float, **attributes) -> None:
+    """
+    Records an already finished span with the current tracer, if any.
+    """
+    tracer = Tracer._shared
+    if tracer is not None:
+        tracer.record(name, start, end, **attributes)
+
+
+def traced(name: str):
+    """
+    A decorator that runs every call of the function in a span.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_context(f):
+    """
+    Binds a function to a copy of the current context, so that spans it
+    opens when run on another thread nest under the current span.
+    """
+    context = contextvars.copy_context()
+    return functools.partial(context.run, f)
@@ -0,0 +1,89 @@
+import random
+import struct
+
+import pytest
+
+from eywa.ast import *
+from eywa.batch import BatchFilter
+from eywa.ktest import KTest
+from eywa.oracles import DecodePlan
+
+np = pytest.importorskip("numpy")
+
+SIZES = {'?': 1, 'B': 1, 'H': 2, 'I': 4, 'Q': 8}
+
+
+def random_records(plan, n, seed=0):
+    """
+    Returns n tests with one random x<i> object per leaf of the plan, with
+    small values so that enums and bools are mostly in range.
+    """
+    rng = random.Random(seed)
+    formats = plan.struct.format.lstrip('<')
+    records = []
+    for _ in range(n):
+        objects = []
+        for (i, format) in enumerate(formats):
+            value = rng.randrange(2) if format == '?' else rng.choice([0, 1, 2, 3, 65, 97, 200])
+            objects.append((f'x{i}', struct.pack('<' + format, value)))
+        records.append(KTest([], objects))
+    return records
+
+
+def check(parameters, precondition, has_valid_input_param=False):
+    types = [parameter.type for parameter in parameters]
+    if has_valid_input_param:
+        types.append(Bool())
+    plan = DecodePlan(types)
+    records = random_records(plan, 200)
+    batch = BatchFilter(plan, parameters, precondition, has_valid_input_param)
+    scalar = [batch._scalar(plan.decode(record)) for record in records]
+    expected = [klee_input for klee_input in scalar if klee_input is not None]
+    assert list(batch.filter(records)) == expected
+    return expected
+
+
+def test_bool_conjunct():
+    flag = Parameter("flag", Bool())
+    n = Parameter("n", Int(32))
+    other = Parameter("other", Bool())
+    expected = check([flag, n, other], Expr.convert(flag) & (n > 3))
+    assert len(expected) > 0
+
+
+def test_negated_bool_conjunct():
+    flag = Parameter("flag", Bool())
+    n = Parameter("n", Int(8))
+    check([flag, n], Not(Bool(), Expr.convert(flag)) & (n < 100), has_valid_input_param=True)
+
+
+def test_enum_conjuncts():
+    color = Parameter("color", Enum("Color", ["RED", "GREEN", "BLUE"]))
+    n = Parameter("n", Int(32))
+    check([color, n], (color == Const(color.type, "GREEN")) & (n >= 2))
+    check([color, n], Expr.convert(color) & (n >= 2))
+
+
+def test_char_conjuncts():
+    c = Parameter("c", Char())
+    n = Parameter("n", Int(16))
+    check([c, n], (c == Const(Char(), 'a')) | (n == 2))
+    check([c, n], Expr.convert(c) & (n != 0))
+
+
+def test_forall_conjunct():
+    values = Parameter("values", Array(Int(32), 3))
+    flags = Parameter("flags", Array(Bool(), 2))
+    check([values, flags], values.forall(lambda x: x > 1) & flags.forall(lambda f: f))
+
+
+def test_int64_arithmetic():
+    n = Parameter("n", Int(64))
+    m = Parameter("m", Int(32))
+    plan = DecodePlan([n.type, m.type])
+    values = [(0, 0), (10, 3), (2 ** 64 - 1, 2 ** 32 - 1), (6, 7)]
+    records = [KTest([], [('x0', struct.pack('<Q', a)), ('x1', struct.pack('<I', b))]) for (a, b) in values]
+    for precondition in [(n - 1) > 5, (m - 4) < (n + 1), (n + m) >= 2 ** 64]:
+        batch = BatchFilter(plan, [n, m], precondition, False)
+        scalar = [batch._scalar(plan.decode(record)) for record in records]
+        assert list(batch.filter(records)) == [klee_input for klee_input in scalar if klee_input is not None]